@@ -0,0 +1,131 @@
+import re
+
+import numpy as np
+import joblib
+from pandas import read_csv
+from sklearn.ensemble import RandomForestRegressor
+from sklearn.model_selection import GridSearchCV, GroupKFold, GroupShuffleSplit
+from sklearn.neural_network import MLPRegressor
+from sklearn.pipeline import make_pipeline
+from sklearn.preprocessing import StandardScaler
+
+import feature_extraction
+
+# Columns of the feature table which are not model inputs
+NON_FEATURE_COLUMNS = ['Filename', 'SBP', 'DBP', 'REAL_HR']
+TARGETS = ['SBP', 'DBP']
+
+# Recordings are grouped by subject so that no subject ends up in both the train and the test set.
+# The subject is the part of the filename before the first '_', '-', space or '.'.
+SUBJECT_PATTERN = r"^([^_\-\s.]+)"
+
+TEST_SIZE = 0.3  # Same holdout as betterSplit.m
+CV_FOLDS = 5
+
+# Hyperparameter grids. The MLP mirrors the ranges betterSplit.m gives fitrnet (1-5 layers, up to 400 neurons) coarsely.
+RF_GRID = {
+    'randomforestregressor__n_estimators': [100, 300],
+    'randomforestregressor__max_depth': [None, 10, 20],
+    'randomforestregressor__min_samples_leaf': [1, 3, 5],
+}
+MLP_GRID = {
+    'mlpregressor__hidden_layer_sizes': [(10,), (50,), (200,), (50, 50), (100, 100, 100)],
+    'mlpregressor__activation': ['relu', 'tanh'],
+    'mlpregressor__alpha': [1e-4, 1e-2, 1],
+}
+
+# ===============================================================================================================================
+# LOADING AND SPLITTING
+# ===============================================================================================================================
+
+def _load_features(filename):
+    """Loads a feature table written by "extract" or "sweep".
+Returns the table (rows without targets dropped) and the feature columns which have any values."""
+    table = read_csv(filename, index_col=0)
+    table = table.dropna(subset=TARGETS)
+
+    columns = [c for c in feature_extraction.ECG_COLUMNS if c not in NON_FEATURE_COLUMNS and c in table.columns]
+    # D12 is never filled in, drop any column like it
+    columns = [c for c in columns if table[c].notna().any()]
+    table = table.dropna(subset=columns)
+    return table, columns
+
+def _subject_id(filename, pattern=SUBJECT_PATTERN):
+    "Gets the subject a recording belongs to from its filename"
+    match = re.match(pattern, str(filename))
+    return match.group(1) if match else str(filename)
+
+def _grouped_split(table, test_size=TEST_SIZE, seed=0, pattern=SUBJECT_PATTERN):
+    "Holdout split like betterSplit.m, but by subject. Returns the train and test tables"
+    groups = table["Filename"].map(lambda f: _subject_id(f, pattern))
+    train_idx, test_idx = next(GroupShuffleSplit(n_splits=1, test_size=test_size, random_state=seed).split(table, groups=groups))
+    return table.iloc[train_idx], table.iloc[test_idx]
+
+# ===============================================================================================================================
+# TRAINING AND EVALUATION
+# ===============================================================================================================================
+
+def _search(kind, seed=0, folds=CV_FOLDS):
+    """Builds the model and hyperparameter search for 'rf' or 'mlp'. Folds and candidates run on all cores
+The MLP gets standardized inputs (trees don't need them). It trains without early stopping, since sklearn would hold out a random,
+ungrouped validation split and windows of one subject would land on both sides. alpha in the grid regularizes it instead."""
+    if kind == 'rf':
+        model = make_pipeline(RandomForestRegressor(random_state=seed))
+        grid = RF_GRID
+    elif kind == 'mlp':
+        model = make_pipeline(StandardScaler(), MLPRegressor(max_iter=2000, random_state=seed))
+        grid = MLP_GRID
+    else:
+        raise ValueError("Unknown model kind: " + kind)
+
+    return GridSearchCV(model, grid, cv=GroupKFold(n_splits=folds), scoring='neg_mean_absolute_error', n_jobs=-1)
+
+def _train(train, columns, kind, seed=0, pattern=SUBJECT_PATTERN):
+    """Trains one model per target with a subject-grouped cross-validated hyperparameter search. Returns {target: best model}
+Uses one fold per subject when the training set has fewer than CV_FOLDS subjects, and raises a ValueError with fewer than 2."""
+    groups = train["Filename"].map(lambda f: _subject_id(f, pattern))
+    n_groups = groups.nunique()
+    if n_groups < 2:
+        raise ValueError("Need recordings of at least 2 subjects in the training set for grouped cross-validation, got " + str(n_groups))
+
+    models = {}
+    for target in TARGETS:
+        search = _search(kind, seed, min(CV_FOLDS, n_groups))
+        search.fit(train[columns].to_numpy(dtype=float), train[target].to_numpy(dtype=float), groups=groups)
+        models[target] = search.best_estimator_
+    return models
+
+def _bhs_grade(errors):
+    "British Hypertension Society grade from the cumulative percentage of absolute errors within 5, 10 and 15 mmHg"
+    abs_err = np.abs(errors)
+    within = [100 * np.mean(abs_err <= x) for x in (5, 10, 15)]
+    for grade, limits in (('A', (60, 85, 95)), ('B', (50, 75, 90)), ('C', (40, 65, 85))):
+        if all(w >= l for w, l in zip(within, limits)):
+            return grade, within
+    return 'D', within
+
+def _evaluate(models, test, columns):
+    "Scores each model on the test table. Returns {target: dict of MAE, ME, SD, BHS grade and AAMI pass/fail}"
+    report = {}
+    for target, model in models.items():
+        errors = model.predict(test[columns].to_numpy(dtype=float)) - test[target].to_numpy(dtype=float)
+        grade, within = _bhs_grade(errors)
+        report[target] = {
+            'MAE': np.mean(np.abs(errors)),
+            'ME': np.mean(errors),
+            'SD': np.std(errors),
+            'BHS': grade,
+            'within_5_10_15': within,
+            # AAMI: mean error within 5 mmHg and standard deviation within 8 mmHg
+            'AAMI': abs(np.mean(errors)) <= 5 and np.std(errors) <= 8,
+        }
+    return report
+
+def _save(models, columns, filename):
+    "Saves the trained models with the feature columns they expect, for the inference server"
+    joblib.dump({'models': models, 'columns': columns}, filename)
+
+def _load(filename):
+    "Loads models saved by _save. Returns ({target: model}, columns)"
+    saved = joblib.load(filename)
+    return saved['models'], saved['columns']
@@ -6,12 +6,16 @@ import pywt as wt
 import numpy as np
 import neurokit2 as nk
 
+import signal_utils
+
 # ===============================================================================================================================
 # FEATURE EXTRACTION
 # ===============================================================================================================================
 
 def _decompose(signal):
     "Getting the features for the ecg signal"
+    # Decimate and decompose in double precision, also in the float32 mode. In single precision D11 drifts past FLOAT32_TOLERANCE
+    signal = np.asarray(signal, dtype=float)
     sig = signal
 
     if (2620 % len(sig) == 0):
@@ -76,16 +80,9 @@ def _rr_interval(peaks,fs):
     temp=total/(len(peaks)-1)
     return temp/fs
 
-def _pulse_arrival_time(data,fs,ppg_channel):
-    """Returns the average number of samples between an ECG peak and the proceeding PPG peak
-    Choose which ppg channel to use by giving the key of the channel in ppg_channel. 
-    We can make this more robust with an enum later. Use 'Red' or 'IR'."""
-    # Assumes you've cleaned both channels and put them back in the dataframe!
-    ecg_signal=np.copy(data["ECG"])
-    ppg_signal=np.copy(data[ppg_channel])
-
-    ecg_peaks = nk.ecg_findpeaks(np.copy(ecg_signal),sampling_rate=fs,method="elgendi2010")["ECG_R_Peaks"]
-    ppg_peaks= nk.ppg_findpeaks(np.copy(ppg_signal),sampling_rate=fs,method="elgendi")["PPG_Peaks"] 
+def _pulse_arrival_time(ecg_peaks,ppg_peaks,fs):
+    """Returns the average time between an ECG peak and the proceeding PPG peak.
+Takes the peak indices of both (cleaned) signals, see signal_utils._get_ecg_peaks and signal_utils._get_ppg_peaks."""
 
     total=0
     count=0
@@ -123,8 +120,9 @@ def _avg_time_interval(time,a_indices,b_indices):
     for x in range(0,len(a_indices)):
         if not np.isnan(a_indices[x]) and not np.isnan(b_indices[x]):                       
 
-            b_time=time.iat[b_indices[x]]
-            a_time=time.iat[a_indices[x]]
+            # Stored delineation points come back as floats (NaN marks a missing point), so cast before indexing
+            b_time=time.iat[int(b_indices[x])]
+            a_time=time.iat[int(a_indices[x])]
 
             total=total+b_time-a_time
             count=count+1 
@@ -138,7 +136,105 @@ def _avg_area_under_curve(signal,a_indices,b_indices):
     for x in range(0,len(a_indices)):
         if not np.isnan(a_indices[x]) and not np.isnan(b_indices[x]):                       
             
-            total=total+scipy.integrate.simpson(signal.iloc[a_indices[x]:b_indices[x]])
+            total=total+scipy.integrate.simpson(signal.iloc[int(a_indices[x]):int(b_indices[x])])
             count=count+1 
                
-    return total/count 
\ No newline at end of file
+    return total/count
+
+# ===============================================================================================================================
+# WINDOW FEATURES
+# ===============================================================================================================================
+
+# Columns of the ECG feature table. D12 is kept for compatibility with existing models, the DWT only fills D1-D11.
+ECG_COLUMNS=['Filename', 'SBP', 'DBP', 'REAL_HR', 'HR', 'HRV', 'RR', 'PAT', 
+            'QRSd','PQ','QT','JT', 
+            'AUCqrs_pos','AUCqrs_neg', 'AUCjt_pos', 'AUCjt_neg',
+            'ENT', 'SKEW', 'KURT',
+            'D1','D2','D3','D4','D5','D6','D7','D8','D9','D10','D11','D12']
+
+# Every feature written to the ECG feature table is registered here as name -> (version, columns, function).
+# The function takes a window context (see _window_context) and returns one value per column.
+# Bump the version whenever a feature's definition changes, so the feature store recomputes it.
+FEATURES = {}
+
+def _register(name, version, columns=None):
+    "Decorator which adds a window feature to FEATURES"
+    def wrap(func):
+        FEATURES[name] = (version, columns or [name], func)
+        return func
+    return wrap
+
+def _window_context(data,fs,fiducials,prefix=""):
+    """Marks the components of the ECG in a window of cleaned data and bundles everything the window features need.
+Peaks and delineation points go through the fiducials entry (see fiducial_store) under the given key prefix."""
+    peaks=fiducials.get(prefix+"ECG_R_Peaks", lambda: signal_utils._get_ecg_peaks(data["ECG"],data["Time"],fs)[0])
+    ppg_peaks=fiducials.get(prefix+"PPG_Peaks", lambda: signal_utils._get_ppg_peaks(data["Red"],fs))
+    points=fiducials.get_points(prefix+"ECG_Points", lambda: nk.ecg_delineate(data["ECG"],peaks,sampling_rate=fs)[1])
+
+    return {"data":data, "fs":fs, "peaks":peaks, "peak_times":data["Time"].iloc[peaks], "ppg_peaks":ppg_peaks, "points":points}
+
+@_register('HR', 1)
+def _feat_hr(w):
+    return [_ecg_heart_rate(w["peak_times"])]
+
+@_register('HRV', 1)
+def _feat_hrv(w):
+    return [_hrv(w["peak_times"])]
+
+@_register('RR', 1)
+def _feat_rr(w):
+    return [_rr_interval(w["peaks"],w["fs"])]
+
+@_register('PAT', 1)
+def _feat_pat(w):
+    return [_pulse_arrival_time(w["peaks"],w["ppg_peaks"],w["fs"])]
+
+@_register('QRSd', 1)
+def _feat_qrsd(w):
+    return [_avg_time_interval(w["data"]["Time"],w["points"]["ECG_Q_Peaks"],w["points"]["ECG_S_Peaks"])]
+
+@_register('PQ', 1)
+def _feat_pq(w):
+    return [_avg_time_interval(w["data"]["Time"],w["points"]["ECG_P_Onsets"],w["points"]["ECG_Q_Peaks"])]
+
+@_register('QT', 1)
+def _feat_qt(w):
+    return [_avg_time_interval(w["data"]["Time"],w["points"]["ECG_Q_Peaks"],w["points"]["ECG_T_Offsets"])]
+
+@_register('JT', 1)
+def _feat_jt(w):
+    return [_avg_time_interval(w["data"]["Time"],w["points"]["ECG_S_Peaks"],w["points"]["ECG_T_Peaks"])]
+
+@_register('AUCqrs_pos', 1)
+def _feat_aucqrs_pos(w):
+    return [_avg_area_under_curve(w["data"]["ECG"].clip(lower=0,upper=None),w["points"]["ECG_Q_Peaks"],w["points"]["ECG_S_Peaks"])]
+
+@_register('AUCqrs_neg', 1)
+def _feat_aucqrs_neg(w):
+    return [_avg_area_under_curve(w["data"]["ECG"].clip(lower=None,upper=0),w["points"]["ECG_Q_Peaks"],w["points"]["ECG_S_Peaks"])]
+
+@_register('AUCjt_pos', 1)
+def _feat_aucjt_pos(w):
+    return [_avg_area_under_curve(w["data"]["ECG"].clip(lower=0,upper=None),w["points"]["ECG_S_Peaks"],w["points"]["ECG_T_Offsets"])]
+
+@_register('AUCjt_neg', 1)
+def _feat_aucjt_neg(w):
+    return [_avg_area_under_curve(w["data"]["ECG"].clip(lower=None,upper=0),w["points"]["ECG_S_Peaks"],w["points"]["ECG_T_Offsets"])]
+
+@_register('ENT', 1)
+def _feat_ent(w):
+    return [_sample_entropy(w["data"]["ECG"])]
+
+@_register('SKEW', 1)
+def _feat_skew(w):
+    return [_skew(w["data"]["ECG"])]
+
+@_register('KURT', 1)
+def _feat_kurt(w):
+    return [_kurt(w["data"]["ECG"])]
+
+@_register('DWT', 2, ['D'+str(x) for x in range(1,12)])
+def _feat_dwt(w):
+    D=_decompose(w["data"]["ECG"])[0]
+    return [D[x] for x in range(0,11)]
+
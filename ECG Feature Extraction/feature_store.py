@@ -0,0 +1,100 @@
+import os
+
+import numpy as np
+
+import fiducial_store
+
+# Columnar store of computed window features, keyed by (recording, window start, window end).
+# Recordings are identified by their content hash (see fiducial_store._recording_hash), so a renamed copy reuses its values
+# and an edited recording, or another one with the same filename, gets its features recomputed.
+# Every recording gets one .npz per registered feature (see feature_extraction.FEATURES) and version, inside a directory
+# per preprocessing parameter set, so a run only computes the (window, feature) cells that are missing or stale.
+STORE_DIR = ".features"
+
+# ===============================================================================================================================
+# FEATURE STORE
+# ===============================================================================================================================
+
+class FeatureStore:
+    """Stored feature values for one preprocessing parameter set. A recording's features are loaded on first use,
+and save() writes back the ones that got new cells. A store opened without a directory just behaves as an in-memory table."""
+
+    def __init__(self, store_dir, features, params):
+        self.features = features
+        self.dir = None if store_dir is None else os.path.join(store_dir, fiducial_store._params_hash(params))
+        self.cells = {}
+        self.dirty = set()
+
+    def _path(self, name, rec):
+        version = self.features[name][0]
+        return os.path.join(self.dir, rec, name + ".v" + str(version) + ".npz")
+
+    def _cells(self, name, rec):
+        "The stored cells of one feature of one recording as {(start, end): values}, loaded from disk on first use"
+        if (name, rec) not in self.cells:
+            self.cells[(name, rec)] = self._read(name, rec)
+        return self.cells[(name, rec)]
+
+    def _read(self, name, rec):
+        "The cells of one feature of one recording as currently on disk"
+        cells = {}
+        if self.dir is None:
+            return cells
+        columns = self.features[name][1]
+        try:
+            with np.load(self._path(name, rec), allow_pickle=False) as npz:
+                values = np.column_stack([npz[c] for c in columns])
+                for key, row in zip(zip(npz["Start"], npz["End"]), values):
+                    cells[(int(key[0]), int(key[1]))] = list(row)
+        except FileNotFoundError:
+            pass
+        return cells
+
+    def missing(self, rec, start, end):
+        "Names of the registered features which have no current value for this window of the recording with hash rec"
+        key = (int(start), int(end))
+        return [name for name in self.features if key not in self._cells(name, rec)]
+
+    def put(self, name, rec, start, end, values):
+        self._cells(name, rec)[(int(start), int(end))] = list(values)
+        self.dirty.add((name, rec))
+
+    def row(self, rec, start, end):
+        "All stored values of a window as {column: value}"
+        key = (int(start), int(end))
+        row = {}
+        for name, (_, columns, _) in self.features.items():
+            row.update(zip(columns, self._cells(name, rec)[key]))
+        return row
+
+    def save(self):
+        "Writes back every (feature, recording) that got new cells and removes the files of that feature's older versions"
+        if self.dir is None:
+            self.dirty.clear()
+            return
+
+        for name, rec in self.dirty:
+            # Shards or workers sharing the store may have saved other windows of the recording since it was read, keep them too
+            cells = self._read(name, rec)
+            cells.update(self._cells(name, rec))
+            self.cells[(name, rec)] = cells
+            keys = list(cells.keys())
+            values = np.array([cells[k] for k in keys], dtype=float).reshape(len(keys), -1)
+
+            arrays = {
+                "Start": np.array([k[0] for k in keys], dtype=np.int64),
+                "End": np.array([k[1] for k in keys], dtype=np.int64),
+            }
+            for i, column in enumerate(self.features[name][1]):
+                arrays[column] = values[:, i]
+
+            rec_dir = os.path.dirname(self._path(name, rec))
+            os.makedirs(rec_dir, exist_ok=True)
+
+            fiducial_store._write_atomic(self._path(name, rec), lambda f: np.savez(f, **arrays))
+
+            for f in os.listdir(rec_dir):
+                if f.startswith(name + ".v") and f.endswith(".npz") and f != os.path.basename(self._path(name, rec)):
+                    fiducial_store._remove(os.path.join(rec_dir, f))
+
+        self.dirty.clear()
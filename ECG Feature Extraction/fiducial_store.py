@@ -0,0 +1,169 @@
+import hashlib
+import os
+import tempfile
+
+import numpy as np
+import neurokit2 as nk
+
+# Sidecar store for the expensive neurokit outputs (cleaned signals, peaks, delineation points).
+# One compressed .npz per recording, keyed on the recording's content hash and the preprocessing parameters.
+STORE_DIR = ".fiducials"
+MAX_STORE_BYTES = 512 * 2 ** 20
+
+# Bump this when the meaning of a stored array changes, so older entries are recomputed instead of reused.
+STORE_VERSION = 1
+
+# ===============================================================================================================================
+# SIDECAR STORE
+# ===============================================================================================================================
+
+def _recording_hash(filename):
+    "Hashes the raw contents of a recording, so renamed copies share an entry and edited files don't"
+    sha = hashlib.sha1()
+    with open(filename, "rb") as f:
+        for chunk in iter(lambda: f.read(2 ** 20), b""):
+            sha.update(chunk)
+    return sha.hexdigest()
+
+def _bytes_hash(raw):
+    "Same as _recording_hash, for a recording whose bytes were already read (e.g. to be parsed from memory)"
+    return hashlib.sha1(raw).hexdigest()
+
+def _read_recording(filename):
+    "Reads a recording once for both hashing and parsing. Returns (raw bytes, content hash)"
+    with open(filename, "rb") as f:
+        raw = f.read()
+    return raw, _bytes_hash(raw)
+
+def _params_hash(params):
+    "Hashes the preprocessing parameters. Any change to them (or to neurokit itself) gives a different key"
+    key = repr(sorted(params.items())) + nk.__version__ + str(STORE_VERSION)
+    return hashlib.sha1(key.encode()).hexdigest()[:12]
+
+def _params(target_rate=None, dtype=None):
+    "The preprocessing parameters which stored results depend on"
+    params = {"target_rate": target_rate}
+    # Only added in the low-memory mode, so double precision entries from before it existed stay valid
+    if dtype is not None:
+        params["dtype"] = np.dtype(dtype).name
+    return params
+
+def _evict(store_dir, max_bytes):
+    "Removes the least recently used entries until the store fits in max_bytes"
+    entries = []
+    for f in os.listdir(store_dir):
+        if f.endswith(".npz"):
+            # Another worker may be evicting from the same store at the same time
+            try:
+                stat = os.stat(os.path.join(store_dir, f))
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, os.path.join(store_dir, f)))
+    entries.sort()
+
+    total = sum(size for _, size, _ in entries)
+    for _, size, f in entries:
+        if total <= max_bytes:
+            break
+        total -= size
+        _remove(f)
+
+def _write_atomic(path, write):
+    """Writes a file through a uniquely named temporary file next to it, then renames it into place.
+An interrupted run can't leave a truncated file behind, and workers or shards writing the same file don't share a temporary."""
+    fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            write(f)
+        os.replace(tmp, path)
+    except BaseException:
+        try:
+            os.remove(tmp)
+        except FileNotFoundError:
+            pass
+        raise
+
+def _remove(path):
+    "Removes a file another worker or shard may already have removed"
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+class FiducialEntry:
+    """The stored fiducials of one recording. Arrays are computed on first request and written back by save().
+An entry opened without a store directory just behaves as an in-memory cache."""
+
+    def __init__(self, store_dir, rec_hash, params_hash):
+        self.store_dir = store_dir
+        self.rec_hash = rec_hash
+        self.params_hash = params_hash
+        self.arrays = {}
+        self.dirty = False
+
+        if store_dir is not None and os.path.isfile(self.path()):
+            try:
+                with np.load(self.path(), allow_pickle=False) as npz:
+                    self.arrays = {k: npz[k] for k in npz.files}
+                # Mark as recently used for the eviction policy
+                os.utime(self.path())
+            except FileNotFoundError:
+                # Evicted by another worker in the meantime, just recompute
+                self.arrays = {}
+
+    def path(self):
+        return os.path.join(self.store_dir, self.rec_hash + "-" + self.params_hash + ".npz")
+
+    def get(self, key, compute):
+        "Returns the stored array under key, calling compute() to fill it in if it is missing"
+        if key not in self.arrays:
+            self.arrays[key] = np.asarray(compute())
+            self.dirty = True
+        return self.arrays[key]
+
+    def get_points(self, prefix, compute):
+        """Like get(), for a dictionary of index arrays such as the output of nk.ecg_delineate.
+Missing points (NaN) force the arrays to float, so callers must cast indices back to int."""
+        if prefix not in self.arrays:
+            points = compute()
+            self.arrays[prefix] = np.array(list(points.keys()), dtype=str)
+            for name, values in points.items():
+                self.arrays[prefix + "__" + name] = np.asarray(values, dtype=float)
+            self.dirty = True
+        return {name: self.arrays[prefix + "__" + name] for name in self.arrays[prefix]}
+
+    def save(self, max_bytes=MAX_STORE_BYTES):
+        "Writes the entry back if anything new was computed, drops stale entries of the same recording and evicts old ones"
+        if self.store_dir is None or not self.dirty:
+            return
+
+        os.makedirs(self.store_dir, exist_ok=True)
+
+        # Another worker may have saved arrays of the same recording since this entry was opened, keep them too
+        arrays = dict(self.arrays)
+        try:
+            with np.load(self.path(), allow_pickle=False) as npz:
+                for k in npz.files:
+                    arrays.setdefault(k, npz[k])
+        except (FileNotFoundError, ValueError, OSError):
+            pass
+
+        _write_atomic(self.path(), lambda f: np.savez_compressed(f, **arrays))
+        self.arrays = arrays
+        self.dirty = False
+
+        # Entries for the same recording under other parameters are stale now
+        for f in os.listdir(self.store_dir):
+            if f.startswith(self.rec_hash + "-") and f.endswith(".npz") and f != os.path.basename(self.path()):
+                _remove(os.path.join(self.store_dir, f))
+
+        _evict(self.store_dir, max_bytes)
+
+def _open(store_dir, filename, params, rec_hash=None):
+    """Opens the stored fiducials of a recording under the given preprocessing parameters.
+Pass rec_hash if the recording was already hashed (e.g. while it was being loaded) to avoid reading it again."""
+    if store_dir is None:
+        return FiducialEntry(None, None, None)
+    if rec_hash is None:
+        rec_hash = _recording_hash(filename)
+    return FiducialEntry(store_dir, rec_hash, _params_hash(params))
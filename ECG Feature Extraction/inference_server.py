@@ -0,0 +1,255 @@
+import json
+import os
+import queue
+import threading
+import time
+from collections import deque
+from concurrent.futures import Future, ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import numpy as np
+from pandas import DataFrame
+
+import signal_utils
+import preprocessing
+import feature_extraction
+import fiducial_store
+import bp_models
+
+# Requests are collected into micro-batches of up to BATCH_SIZE windows, waiting at most BATCH_WAIT seconds for a batch to fill.
+# Feature extraction for a batch is spread over a pool of warm worker processes, then both models predict the whole batch at once.
+BATCH_SIZE = 32
+BATCH_WAIT = 0.01
+
+# Latencies of the last LATENCY_WINDOW requests are kept for the percentiles
+LATENCY_WINDOW = 10000
+
+DEFAULT_PORT = 8008
+
+# ===============================================================================================================================
+# FEATURES
+# ===============================================================================================================================
+
+def _window_features(window, columns, target_rate):
+    """Runs the extract preprocessing and feature chain on one raw window and returns the values of the given columns.
+The window is a request body: {"fs": sample rate, "ecg": [...], "ppg": [...]} and optionally "time" in ms and "pad".
+"extract" cleans whole recordings, so its windows don't see the filters' edge effects. To match it, send "pad" samples of
+signal on each side of the window: they are cleaned with it and cropped before the features. Without padding the filters
+settle inside the window, and the features can differ from the ones the models were trained on."""
+    fs = float(window["fs"])
+    ecg = np.asarray(window["ecg"], dtype=float)
+    ppg = np.asarray(window["ppg"], dtype=float)
+    if len(ecg) != len(ppg):
+        raise ValueError("ecg and ppg must have the same length")
+
+    pad = int(window.get("pad", 0))
+    if pad < 0 or 2 * pad >= len(ecg):
+        raise ValueError("pad must leave some of the window on both sides")
+
+    times = window.get("time")
+    if times is None:
+        times = np.arange(len(ecg)) / (fs * signal_utils.TIME_UNIT)
+    data = DataFrame({"Time": np.asarray(times, dtype=float), "ECG": ecg, "Red": ppg})
+
+    if target_rate is not None:
+        data = signal_utils._resample(data, fs, target_rate)
+        pad = int(round(pad * target_rate / fs))
+        fs = target_rate
+
+    data["ECG"] = preprocessing._cleanECG(data["ECG"], fs)
+    data["Red"] = preprocessing._cleanPPG(data["Red"], fs)
+    if pad:
+        data = data.iloc[pad:len(data) - pad].reset_index(drop=True)
+
+    # Nothing to reuse between requests, so the fiducials just live in memory
+    context = feature_extraction._window_context(data, fs, fiducial_store.FiducialEntry(None, None, None))
+
+    values = {}
+    for _, feature_columns, func in feature_extraction.FEATURES.values():
+        if any(c in columns for c in feature_columns):
+            values.update(zip(feature_columns, func(context)))
+    return [values[c] for c in columns]
+
+def _safe_window_features(window, columns, target_rate):
+    "Worker wrapper so one bad window fails its own request instead of the whole batch. Returns (values, error)"
+    try:
+        return _window_features(window, columns, target_rate), None
+    except (KeyError, ValueError, IndexError, TypeError, ZeroDivisionError) as e:
+        return None, repr(e)
+
+def _warm_up():
+    "No-op task. Running it starts a worker process and, with the spawn start method, imports this module and neurokit in it"
+    return None
+
+# ===============================================================================================================================
+# SERVER
+# ===============================================================================================================================
+
+class InferenceServer:
+    "Keeps the models and feature workers warm and micro-batches concurrent prediction requests"
+
+    def __init__(self, model_file, target_rate=None, workers=None, batch_size=BATCH_SIZE, batch_wait=BATCH_WAIT):
+        self.models, self.columns = bp_models._load(model_file)
+        self.target_rate = target_rate
+        self.batch_size = batch_size
+        self.batch_wait = batch_wait
+
+        self.workers = workers
+        self.pool = self._start_pool()
+        self.pending = queue.Queue()
+
+        self.lock = threading.Lock()
+        self.latencies = deque(maxlen=LATENCY_WINDOW)
+        self.num_requests = 0
+        self.num_errors = 0
+        self.num_batches = 0
+        self.started = time.monotonic()
+
+        self.batcher = threading.Thread(target=self._run_batches, daemon=True)
+        self.batcher.start()
+
+    def _start_pool(self):
+        """Starts the feature workers right away with one no-op per worker. The pool would otherwise start them on the first batch,
+which would pay for the process starts (and imports) and show up in the p99 latency."""
+        pool = ProcessPoolExecutor(max_workers=self.workers)
+        for future in [pool.submit(_warm_up) for _ in range(self.workers or os.cpu_count() or 1)]:
+            future.result()
+        return pool
+
+    def predict(self, window):
+        "Queues a window and blocks until its batch is done. Returns {target: estimate}"
+        start = time.monotonic()
+        result = Future()
+        self.pending.put((window, result))
+        try:
+            return result.result()
+        finally:
+            with self.lock:
+                self.latencies.append(time.monotonic() - start)
+                self.num_requests += 1
+                if result.exception() is not None:
+                    self.num_errors += 1
+
+    def _next_batch(self):
+        "Waits for a request, then collects more until the batch is full or batch_wait has passed"
+        batch = [self.pending.get()]
+        deadline = time.monotonic() + self.batch_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.pending.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run_batches(self):
+        while True:
+            batch = self._next_batch()
+            try:
+                self._predict_batch(batch)
+            except BrokenProcessPool as e:
+                # A worker died (e.g. killed for memory). Fail this batch and start new workers for the next ones
+                for _, result in batch:
+                    if not result.done():
+                        result.set_exception(e)
+                self.pool.shutdown(wait=False, cancel_futures=True)
+                self.pool = self._start_pool()
+            except Exception as e:
+                # Never leave a request hanging, whatever went wrong
+                for _, result in batch:
+                    if not result.done():
+                        result.set_exception(e)
+            with self.lock:
+                self.num_batches += 1
+
+    def _predict_batch(self, batch):
+        "Extracts the features of every window in the batch in parallel, then predicts them all at once"
+        windows = [window for window, _ in batch]
+        n = len(windows)
+        extracted = list(self.pool.map(_safe_window_features, windows, [self.columns] * n, [self.target_rate] * n))
+
+        ok = [i for i, (values, _) in enumerate(extracted) if values is not None]
+        predictions = {}
+        if ok:
+            X = np.array([extracted[i][0] for i in ok], dtype=float)
+            predictions = {target: model.predict(X) for target, model in self.models.items()}
+
+        for j, i in enumerate(ok):
+            batch[i][1].set_result({target: float(p[j]) for target, p in predictions.items()})
+        for i, (values, error) in enumerate(extracted):
+            if values is None:
+                batch[i][1].set_exception(ValueError(error))
+
+    def metrics(self):
+        "Latency percentiles, throughput and counters since the server started"
+        with self.lock:
+            latencies = np.array(self.latencies)
+            elapsed = time.monotonic() - self.started
+            return {
+                "requests": self.num_requests,
+                "errors": self.num_errors,
+                "batches": self.num_batches,
+                "mean_batch_size": self.num_requests / self.num_batches if self.num_batches else 0,
+                "throughput_per_s": self.num_requests / elapsed if elapsed > 0 else 0,
+                "p50_ms": float(np.percentile(latencies, 50) * 1000) if len(latencies) else None,
+                "p99_ms": float(np.percentile(latencies, 99) * 1000) if len(latencies) else None,
+            }
+
+    def close(self):
+        self.pool.shutdown(cancel_futures=True)
+
+def _handler(server):
+    "Builds the HTTP handler. POST /predict takes a window as JSON, GET /metrics returns the counters"
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, code, body):
+            payload = json.dumps(body).encode()
+            self.send_response(code)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(payload)))
+            self.end_headers()
+            self.wfile.write(payload)
+
+        def do_GET(self):
+            if self.path == "/metrics":
+                self._reply(200, server.metrics())
+            else:
+                self._reply(404, {"error": "not found"})
+
+        def do_POST(self):
+            if self.path != "/predict":
+                self._reply(404, {"error": "not found"})
+                return
+            try:
+                window = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+            except ValueError:
+                self._reply(400, {"error": "expected a JSON body"})
+                return
+            try:
+                self._reply(200, server.predict(window))
+            except ValueError as e:
+                self._reply(422, {"error": str(e)})
+            except Exception as e:
+                self._reply(500, {"error": repr(e)})
+
+        def log_message(self, format, *args):
+            # Per-request logging would dominate the latency, the counters are in /metrics
+            return
+
+    return Handler
+
+def _serve(model_file, port=DEFAULT_PORT, target_rate=None, workers=None):
+    "Serves predictions on localhost until interrupted"
+    server = InferenceServer(model_file, target_rate, workers)
+    httpd = ThreadingHTTPServer(("127.0.0.1", port), _handler(server))
+    print("Serving on http://127.0.0.1:" + str(port) + " (POST /predict, GET /metrics). Ctrl-C to stop")
+    try:
+        httpd.serve_forever()
+    except KeyboardInterrupt:
+        print("Stopping")
+    finally:
+        httpd.server_close()
+        server.close()
@@ -0,0 +1,168 @@
+import numpy as np
+from pandas import DataFrame
+
+import signal_utils
+
+# Columns of the PPG feature table. Times are in ms (like the ECG intervals), the rest are ratios to the systolic amplitude,
+# since the amplitude of the raw PPG depends too much on the sensor and skin to be useful on its own.
+PPG_COLUMNS = ['Filename', 'SBP', 'DBP', 'REAL_HR', 'HR', 'HRV',
+               'CT', 'NT', 'DT',
+               'NR', 'RI',
+               'AUCsys', 'AUCdia', 'IPA',
+               'VPG', 'APG_BA']
+
+# Beats are scored by their correlation with the recording's average beat, and windows need every beat above this.
+# Every beat is resampled to QUALITY_SAMPLES points first, so beats of any length are compared over their whole shape.
+PPG_QUALITY_THRESHOLD = 0.9
+QUALITY_SAMPLES = 64
+
+# Peak intervals longer than this many times the median (missed peaks, dropouts) are gaps, not beats.
+# The beats on either side of a gap are dropped and windows don't span it, which also bounds the width of the beat matrices.
+MAX_BEAT_FACTOR = 1.5
+
+# ===============================================================================================================================
+# FIDUCIALS
+# ===============================================================================================================================
+# Every beat runs from one foot to the next. The search for each fiducial is done for all beats at once on a NaN padded
+# (beats x samples) matrix, so the cost of a recording is a handful of numpy calls rather than a Python loop per beat.
+
+def _segments(x, starts, ends):
+    "Gathers x[starts[k]:ends[k]] for every k into the rows of a NaN padded matrix. Returns (values, sample indices)"
+    ends = np.maximum(ends, starts + 1)
+    lengths = ends - starts
+    offsets = np.arange(lengths.max())
+    idx = starts[:, None] + offsets[None, :]
+    valid = (offsets[None, :] < lengths[:, None]) & (idx < len(x))
+    values = np.where(valid, x[np.minimum(idx, len(x) - 1)], np.nan)
+    return values, idx
+
+def _argext(x, starts, ends, arg):
+    "Index of the extreme (arg is np.nanargmax or np.nanargmin) of x in [starts[k], ends[k]) for every k"
+    values, idx = _segments(x, starts, ends)
+    return idx[np.arange(len(starts)), arg(values, axis=1)]
+
+def _ppg_fiducials(signal, sample_rate, peaks):
+    """Finds the fiducials of every complete beat of a cleaned PPG signal, given its systolic peaks.
+Returns a dictionary of per-beat sample indices and the first and second derivatives, or None with fewer than 3 peaks."""
+    x = np.asarray(signal, dtype=float)
+    peaks = np.sort(np.asarray(peaks, dtype=int))
+    if len(peaks) < 3:
+        return None
+
+    intervals = np.diff(peaks)
+    max_interval = int(MAX_BEAT_FACTOR * np.median(intervals))
+    gap = intervals > max_interval
+
+    # The foot of a beat is the lowest point between the previous systolic peak and its own.
+    # The search is capped at max_interval, the feet it finds across a gap belong to dropped beats anyway.
+    feet = _argext(x, peaks[:-1], np.minimum(peaks[1:], peaks[:-1] + max_interval), np.nanargmin)
+
+    # A beat runs from the foot before its peak to the one after, so both intervals around the peak must be real
+    keep = np.flatnonzero(~gap[:-1] & ~gap[1:])
+    if len(keep) == 0:
+        return None
+    foot, peak, next_foot = feet[keep], peaks[1:-1][keep], feet[keep + 1]
+
+    d1 = np.gradient(x) * sample_rate
+    d2 = np.gradient(d1) * sample_rate
+
+    # Steepest upslope, then the a (early systolic maximum) and b (following minimum) waves of the second derivative
+    upslope = _argext(d1, foot, peak + 1, np.nanargmax)
+    a = _argext(d2, foot, upslope + 1, np.nanargmax)
+    b = _argext(d2, a, peak + 1, np.nanargmin)
+
+    # The dicrotic notch is where the second derivative peaks again after the systolic peak, in the first two thirds of the descent.
+    # The diastolic peak is the highest point after it.
+    notch = _argext(d2, peak + 1, peak + np.maximum(2 * (next_foot - peak) // 3, 2), np.nanargmax)
+    diastolic = _argext(x, notch, next_foot, np.nanargmax)
+
+    return {"foot": foot, "peak": peak, "next_foot": next_foot, "upslope": upslope, "a": a, "b": b,
+            "notch": notch, "diastolic": diastolic, "d1": d1, "d2": d2, "beat": keep}
+
+def _beat_quality(signal, fid, samples=QUALITY_SAMPLES):
+    "Correlation of every beat with the average beat, after linearly resampling every beat to the same number of samples"
+    x = np.asarray(signal, dtype=float)
+    foot = fid["foot"]
+    span = np.maximum(fid["next_foot"] - foot, 1)
+
+    position = foot[:, None] + np.linspace(0, 1, samples)[None, :] * span[:, None]
+    lo = np.minimum(np.floor(position).astype(int), len(x) - 1)
+    hi = np.minimum(lo + 1, len(x) - 1)
+    weight = position - lo
+    beats = x[lo] * (1 - weight) + x[hi] * weight
+
+    template = beats.mean(axis=0)
+    beats = beats - beats.mean(axis=1, keepdims=True)
+    template = template - template.mean()
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (beats @ template) / (np.linalg.norm(beats, axis=1) * np.linalg.norm(template))
+
+# ===============================================================================================================================
+# FEATURES
+# ===============================================================================================================================
+
+def _ppg_beat_features(signal, time, sample_rate, fid):
+    "Timing, amplitude ratio and area features of every beat, as arrays. Beat periods are included for the heart rate"
+    x = np.asarray(signal, dtype=float)
+    t = np.asarray(time, dtype=float)
+    foot, peak, next_foot, notch = fid["foot"], fid["peak"], fid["next_foot"], fid["notch"]
+
+    base = x[foot]
+    systolic = x[peak] - base
+
+    # Area above the foot level between two fiducials, from a running sum
+    cumulative = np.concatenate(([0], np.cumsum(x)))
+    def area(start, end):
+        return (cumulative[end] - cumulative[start] - base * (end - start)) / sample_rate
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return {
+            "Period": t[next_foot] - t[foot],
+            "CT": t[peak] - t[foot],
+            "NT": t[notch] - t[foot],
+            "DT": t[next_foot] - t[notch],
+            "NR": (x[notch] - base) / systolic,
+            "RI": (x[fid["diastolic"]] - base) / systolic,
+            "AUCsys": area(foot, notch) / systolic * 1000,
+            "AUCdia": area(notch, next_foot) / systolic * 1000,
+            "IPA": area(notch, next_foot) / area(foot, notch),
+            "VPG": fid["d1"][fid["upslope"]] / systolic,
+            "APG_BA": fid["d2"][fid["b"]] / fid["d2"][fid["a"]],
+        }
+
+def _window_means(values, firsts, length):
+    "Mean of values[first:first+length] for every first, ignoring NaNs, from running sums"
+    ok = np.isfinite(values)
+    sums = np.concatenate(([0], np.cumsum(np.where(ok, values, 0))))
+    counts = np.concatenate(([0], np.cumsum(ok)))
+    with np.errstate(invalid='ignore', divide='ignore'):
+        return (sums[firsts + length] - sums[firsts]) / (counts[firsts + length] - counts[firsts])
+
+def _ppg_windows(signal, time, sample_rate, peaks, threshold=PPG_QUALITY_THRESHOLD,
+                 length=signal_utils.WINDOW_PULSES, overlap=signal_utils.WINDOW_OVERLAP):
+    """PPG features of every window of `length` good consecutive beats, using the same window policy as the ECG.
+Takes the cleaned signal and its systolic peaks. Returns a DataFrame with the feature columns of PPG_COLUMNS,
+indexed by the sample of each window's first foot."""
+    feature_columns = PPG_COLUMNS[4:]
+    fid = _ppg_fiducials(signal, sample_rate, peaks)
+    if fid is None:
+        return DataFrame(columns=feature_columns)
+
+    beats = _ppg_beat_features(signal, time, sample_rate, fid)
+    quality = _beat_quality(signal, fid)
+
+    # Windows are picked within every run of beats which were consecutive in the recording, so none spans a dropped gap
+    runs = np.split(np.arange(len(quality)), np.flatnonzero(np.diff(fid["beat"]) > 1) + 1)
+    firsts = np.concatenate([run[0] + signal_utils._quality_windows(quality[run], threshold, length, overlap) for run in runs])
+    if len(firsts) == 0:
+        return DataFrame(columns=feature_columns)
+
+    period = _window_means(beats["Period"], firsts, length)
+    windows = {
+        "HR": 60 / (period * signal_utils.TIME_UNIT),
+        "HRV": np.sqrt(np.maximum(_window_means(beats["Period"] ** 2, firsts, length) - period ** 2, 0)),
+    }
+    for column in feature_columns[2:]:
+        windows[column] = _window_means(beats[column], firsts, length)
+
+    return DataFrame(windows, columns=feature_columns, index=fid["foot"][firsts])
@@ -0,0 +1,86 @@
+import numpy as np
+from pandas import DataFrame
+
+import signal_utils
+import preprocessing
+import feature_extraction
+import fiducial_store
+import ppg_feature_extraction
+
+# Largest relative drift of a window feature in the float32 mode (against float64) that "precisioncheck" and the tests accept.
+# Drift is measured relative to the largest magnitude of the feature over the recording's windows.
+FLOAT32_TOLERANCE = 1e-3
+
+class UnsupportedRecording(Exception):
+    "Raised for a recording with neither the ECG nor the PPG columns extract works on"
+
+# ===============================================================================================================================
+# PRECISION CHECK
+# ===============================================================================================================================
+
+def _recording_features(path, target_rate=None, dtype=None):
+    """Runs the extract chain on one recording without any stores. Returns one row per window with Start, End and every feature column
+Raises UnsupportedRecording if the recording has no ECG and Red columns. Windows which fail (e.g. in delineation) are left out."""
+    data, sample_rate = signal_utils._load_recording(path, target_rate, dtype)
+    missing = [c for c in ("Time", "ECG", "Red") if c not in data.columns]
+    if missing:
+        raise UnsupportedRecording("Not an ECG recording, it has no " + ", ".join(missing) + " column")
+    data["ECG"] = preprocessing._cleanECG(data["ECG"], sample_rate)
+    data["Red"] = preprocessing._cleanPPG(data["Red"], sample_rate)
+
+    seg_start, seg_end = signal_utils._seg_bounds(data["ECG"], sample_rate)
+    kSQI_arr = signal_utils._pulse_kSQI(data["ECG"], seg_start, seg_end)
+
+    rows = []
+    for first_pulse in signal_utils._quality_windows(kSQI_arr):
+        start = seg_start[first_pulse]
+        end = seg_end[first_pulse + signal_utils.WINDOW_PULSES - 1]
+        row = {"Start": start, "End": end}
+        try:
+            context = feature_extraction._window_context(data.truncate(before=start, after=end), sample_rate, fiducial_store.FiducialEntry(None, None, None))
+            for _, columns, func in feature_extraction.FEATURES.values():
+                row.update(zip(columns, func(context)))
+        except (KeyError, ValueError, IndexError, ZeroDivisionError):
+            continue
+        rows.append(row)
+    return DataFrame(rows)
+
+def _ppg_recording_features(path, target_rate=None, dtype=None):
+    """Runs the extract chain of a PPG-only recording. Returns one row per window with Start (its first foot) and every PPG feature column
+Raises UnsupportedRecording if the recording has no Green channel."""
+    data, sample_rate = signal_utils._load_recording(path, target_rate, dtype)
+    channel = "Green" if "Green" in data.columns else "GREEN"
+    if channel not in data.columns or "Time" not in data.columns:
+        raise UnsupportedRecording("Not an ECG or PPG recording, it has no ECG, Green or Time column")
+
+    ppg = preprocessing._cleanPPG(data[channel], sample_rate)
+    windows = ppg_feature_extraction._ppg_windows(ppg, data["Time"], sample_rate, signal_utils._get_ppg_peaks(ppg, sample_rate))
+    return windows.rename_axis("Start").reset_index()
+
+def _drift(path, target_rate=None, dtype=np.float32):
+    """Drift of every window feature of one recording in the given precision against double precision.
+ECG recordings are checked on the ECG features, PPG-only recordings on the PPG features.
+Only windows which both precisions select are compared, since a beat's quality can cross the threshold in one and not the other.
+Returns ({column: max relative drift}, number of windows compared, number of windows in double precision)."""
+    try:
+        reference = _recording_features(path, target_rate)
+        compact = _recording_features(path, target_rate, dtype)
+        keys = ["Start", "End"]
+        columns = [c for _, feature_columns, _ in feature_extraction.FEATURES.values() for c in feature_columns]
+    except UnsupportedRecording:
+        reference = _ppg_recording_features(path, target_rate)
+        compact = _ppg_recording_features(path, target_rate, dtype)
+        keys = ["Start"]
+        columns = ppg_feature_extraction.PPG_COLUMNS[4:]
+    if reference.empty or compact.empty:
+        return {}, 0, len(reference)
+
+    both = reference.merge(compact, on=keys, suffixes=("_64", "_32"))
+
+    drift = {}
+    for column in columns:
+        a = both[column + "_64"].to_numpy(dtype=float)
+        b = both[column + "_32"].to_numpy(dtype=float)
+        scale = max(np.nanmax(np.abs(a)), np.finfo(np.float32).eps) if len(a) else 1
+        drift[column] = float(np.nanmax(np.abs(a - b)) / scale) if len(a) else 0.0
+    return drift, len(both), len(reference)
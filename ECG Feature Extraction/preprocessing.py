@@ -7,6 +7,14 @@ import numpy as np
 # FILTERS AND TRANSFORMS
 # ===============================================================================================================================
 
+def _keep_dtype(out, signal):
+    """Casts a filter output back to float32 if the input was float32, so the low-memory mode stays float32 end to end.
+Filters still run in double precision internally. Double precision inputs are returned untouched."""
+    if np.asarray(signal).dtype == np.float32:
+        return np.asarray(out, dtype=np.float32)
+    return out
+
+
 def _cheby(signal, order, atten, corner, sample_rate):
     "Applies a Chebyshev Type II lowpass filter of the specified paramaters to the provided signal"
 
@@ -15,17 +23,17 @@ def _cheby(signal, order, atten, corner, sample_rate):
                     fs=sample_rate)  # use second-order sections to avoid numerical error
 
     # Apply the filter and return the output.
-    return sg.sosfilt(sos, signal)
+    return _keep_dtype(sg.sosfilt(sos, signal), signal)
 
 
 def _cleanECG(signal, sample_rate):
     "Uses neurokit2 to clean an ECG signal"
-    return nk.ecg_clean(signal, sampling_rate=sample_rate, method="elgendi2010")
+    return _keep_dtype(nk.ecg_clean(signal, sampling_rate=sample_rate, method="elgendi2010"), signal)
 
 
 def _cleanPPG(signal, sample_rate):
     "Uses neurokit2 to clean a PPG signal. Also inverts signal to give Real PPG waveform"
-    return nk.ppg_clean(signal, sampling_rate=sample_rate, method='elgendi')
+    return _keep_dtype(nk.ppg_clean(signal, sampling_rate=sample_rate, method='elgendi'), signal)
 
 
 def _butter(signal, corner, sample_rate):
@@ -34,7 +42,7 @@ def _butter(signal, corner, sample_rate):
     b, a = sg.butter(5, corner/(sample_rate/2), 'low')
     
     # Apply the filter and return the output.
-    return sg.filtfilt(b, a, signal)
+    return _keep_dtype(sg.filtfilt(b, a, signal), signal)
 
 def _wavelet(signal):
     "Uses pywavelets to apply wavelet filtering"
@@ -44,7 +52,7 @@ def _wavelet(signal):
     sigma = (1 / 0.6745) * _madev(coeff[-level])
     uthresh = sigma * np.sqrt(2 * np.log(len(signal)))
     coeff[1:] = (wt.threshold(i, value=uthresh, mode='hard') for i in coeff[1:])
-    return wt.waverec(coeff, wavelet, mode='per')
+    return _keep_dtype(wt.waverec(coeff, wavelet, mode='per'), signal)
 
 
 def _madev(d, axis=None):
@@ -0,0 +1,116 @@
+import hashlib
+import json
+import os
+
+from pandas import concat, read_csv
+
+# Sharded extraction: "extract ... --shard k/N" only processes the recordings whose filename hashes to shard k (1 <= k <= N),
+# and writes its own feature table and summary. Shards can run on different machines against a shared filesystem,
+# and "merge" checks that together they covered every recording exactly once before combining them.
+OUTPUT_NAME = "ecg_Features"
+PPG_OUTPUT_NAME = "ppg_Features"
+
+# ===============================================================================================================================
+# PARTITIONING
+# ===============================================================================================================================
+
+def _pop_option(args, name):
+    "Removes a '--name value' option from the argument list and returns its value (None if not given)"
+    if name not in args:
+        return None
+    i = args.index(name)
+    if i + 1 >= len(args):
+        raise ValueError("Missing value for " + name)
+    value = args[i + 1]
+    del args[i:i + 2]
+    return value
+
+def _parse_shard(value):
+    "Parses 'k/N' into (k, N)"
+    try:
+        k, n = (int(x) for x in value.split("/"))
+    except ValueError:
+        raise ValueError("Expected the shard as k/N, e.g. 1/4")
+    if n < 1 or not 1 <= k <= n:
+        raise ValueError("Expected 1 <= k <= N in --shard k/N")
+    return k, n
+
+def _shard_of(file, num_shards):
+    "Shard (1 to num_shards) a recording belongs to. Uses the filename hash, so every machine agrees regardless of listing order"
+    return int(hashlib.sha1(file.encode()).hexdigest(), 16) % num_shards + 1
+
+def _shard_files(files, shard, num_shards):
+    return sorted(f for f in files if _shard_of(f, num_shards) == shard)
+
+def _shard_name(shard, num_shards, name=OUTPUT_NAME):
+    "Output name (without extension) of one shard. The summary goes with the ECG table"
+    return name + ".shard" + str(shard) + "of" + str(num_shards)
+
+def _write_summary(out_dir, shard, num_shards, listed, outcomes, counters, interrupted=False):
+    """Writes what a shard saw: the full directory listing, the outcome of every file it was assigned, its counters and
+whether it was interrupted. The merge step uses this to check coverage."""
+    summary = {
+        "shard": shard,
+        "num_shards": num_shards,
+        "listed": sorted(listed),
+        "outcomes": outcomes,
+        "counters": counters,
+        "interrupted": interrupted,
+    }
+    with open(os.path.join(out_dir, _shard_name(shard, num_shards) + ".json"), "w") as f:
+        json.dump(summary, f, indent=1)
+
+# ===============================================================================================================================
+# MERGE
+# ===============================================================================================================================
+
+def _merge(out_dir, num_shards, names=(OUTPUT_NAME, PPG_OUTPUT_NAME)):
+    """Combines each feature table (ECG and PPG) of all shards and removes duplicate rows.
+Returns ({name: merged table}, summed counters, problems). The tables are None if any shard is missing or was interrupted,
+or the shards did not cover every listed recording exactly once."""
+    problems = []
+    summaries = []
+    tables = {name: [] for name in names}
+
+    for shard in range(1, num_shards + 1):
+        summary = os.path.join(out_dir, _shard_name(shard, num_shards) + ".json")
+        outputs = [os.path.join(out_dir, _shard_name(shard, num_shards, name) + ".csv") for name in names]
+        if not os.path.isfile(summary) or not all(os.path.isfile(f) for f in outputs):
+            problems.append("Shard " + str(shard) + " has no output")
+            continue
+        with open(summary) as f:
+            summaries.append(json.load(f))
+        for name, output in zip(names, outputs):
+            tables[name].append(read_csv(output, index_col=0))
+
+    if problems:
+        return None, {}, problems
+
+    listed = set(summaries[0]["listed"])
+    seen = {}
+    for summary in summaries:
+        shard = summary["shard"]
+        if summary.get("interrupted", False):
+            problems.append("Shard " + str(shard) + " was interrupted, run it again")
+        if set(summary["listed"]) != listed:
+            problems.append("Shard " + str(shard) + " saw a different set of recordings")
+        for file in summary["outcomes"]:
+            if file in seen:
+                problems.append(file + " was processed by shards " + str(seen[file]) + " and " + str(shard))
+            elif _shard_of(file, num_shards) != shard:
+                problems.append(file + " was processed by shard " + str(shard) + " but belongs to shard " + str(_shard_of(file, num_shards)))
+            seen.setdefault(file, shard)
+
+    for file in sorted(listed - set(seen)):
+        problems.append(file + " was not processed by any shard")
+
+    counters = {}
+    for summary in summaries:
+        for key, value in summary["counters"].items():
+            counters[key] = counters.get(key, 0) + value
+
+    if problems:
+        return None, counters, problems
+
+    merged = {name: concat(tables[name], ignore_index=True).drop_duplicates(ignore_index=True) for name in names}
+    return merged, counters, problems
@@ -1,12 +1,32 @@
-from pandas import read_csv
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+from fractions import Fraction
+import io
+from itertools import islice
+import time
+
+from pandas import DataFrame, read_csv
 import numpy as np
 import neurokit2 as nk
 from neurokit2 import signal_power
 from scipy import stats
+from scipy import signal as sg
 
 TIME_UNIT = 10 ** -3
 CSV_HEADER_ROW = 13
 
+# Signal columns of the recordings. In the low-memory mode these are parsed straight to the requested dtype
+SIGNAL_COLUMNS = ['Red', 'IR', 'Green', 'GREEN', 'Ax', 'Ay', 'Az', 'ECG', 'ETI']
+
+# Number of recordings Prefetcher loads ahead of the one being processed
+PREFETCH_DEPTH = 4
+
+# Window policy for feature extraction: windows of WINDOW_PULSES consecutive ECG pulses, all with a kSQI above KSQI_THRESHOLD.
+# Consecutive windows may share up to WINDOW_OVERLAP pulses, i.e. extract slides the window one pulse at a time.
+KSQI_THRESHOLD = 6
+WINDOW_PULSES = 10
+WINDOW_OVERLAP = 9
+
 # ===============================================================================================================================
 # HELPER FUNCTIONS, FILTERS, AND TRANSFORMS GO HERE
 # ===============================================================================================================================
@@ -35,16 +55,67 @@ def _load_txt(filename):
 
     return read_csv(filename, delimiter=",", header=1, converters=converter_dict)
 
-def _load_csv(filename):
-    "Loads the contents of the specified csv into a numpy matrix."
-   
-    data = read_csv(filename, delimiter=",", header=CSV_HEADER_ROW)
+def _load_csv(filename, dtype=None, raw=None):
+    """Loads the contents of the specified csv into a numpy matrix.
+If dtype is given (e.g. np.float32 for the low-memory mode), every signal column is stored as that type. Time keeps its parsed type.
+If raw (the file's bytes) is given, it is parsed instead of reading the file again."""
+    source = lambda: filename if raw is None else io.BytesIO(raw)
+
+    # Only the header row is read to find where it is. Some ppg files have it one row above
+    header = CSV_HEADER_ROW
+    columns = read_csv(source(), delimiter=",", header=header, nrows=0).columns
+    if not "Time" in columns:
+        header = CSV_HEADER_ROW-1
+        columns = read_csv(source(), delimiter=",", header=header, nrows=0).columns
+
+    # Signal columns are parsed straight to dtype, so no double precision copy is ever made
+    column_types = None
+    if dtype is not None:
+        column_types = {c: dtype for c in columns if c in SIGNAL_COLUMNS}
+
+    return read_csv(source(), delimiter=",", header=header, dtype=column_types)
+
+def _load_recording(filename, target_rate=None, dtype=None, raw=None):
+    """Loads a recording and gets its sample rate, resampling it to target_rate if one is given. Returns (data, sample_rate)
+See _load_csv for dtype and raw."""
+    data = _load_csv(filename, dtype, raw)
+    sample_rate = _get_sample_rate(data)
+    if target_rate is not None and not data.empty:
+        data = _resample(data, sample_rate, target_rate)
+        sample_rate = target_rate
+    return data, sample_rate
+
+class Prefetcher:
+    """Iterates over (filename, loaded, error) while loading up to `depth` of the following files on background threads.
+Only `depth` files are ever loaded ahead, which caps the memory held by recordings waiting to be processed.
+An exception raised by load is handed back as error instead of being raised, so the caller can deal with it in its own loop.
+io_wait is the total time spent waiting for a file that wasn't loaded yet."""
+
+    def __init__(self, filenames, load, depth=PREFETCH_DEPTH):
+        self.filenames = filenames
+        self.load = load
+        self.depth = depth
+        self.io_wait = 0.0
+
+    def __iter__(self):
+        remaining = iter(self.filenames)
+        with ThreadPoolExecutor(max_workers=self.depth) as pool:
+            pending = deque((f, pool.submit(self.load, f)) for f in islice(remaining, self.depth))
+            while pending:
+                filename, future = pending.popleft()
+
+                start = time.perf_counter()
+                try:
+                    loaded, error = future.result(), None
+                except Exception as e:
+                    loaded, error = None, e
+                self.io_wait += time.perf_counter() - start
 
-    # Some ppg files have a header one row above
-    if not "Time" in data.iloc[[0]]:
-        data = read_csv(filename, delimiter=",", header=CSV_HEADER_ROW-1)
+                # Start on the next file before handing this one over, so loading overlaps with processing
+                for f in islice(remaining, 1):
+                    pending.append((f, pool.submit(self.load, f)))
 
-    return data
+                yield filename, loaded, error
 
 def _get_sample_rate(data):
     "Calculates the sample rate from the time difference between samples."
@@ -62,6 +133,32 @@ def _get_sample_rate(data):
     avg_period=total/((len(data['Time'])-1))
     return 1/avg_period
 
+def _resample(data, sample_rate, target_rate):
+    """Resamples every signal column of the dataset to target_rate with a polyphase filter.
+The time column is rebuilt as a uniform grid at the rate actually produced, starting at the original first timestamp."""
+
+    # resample_poly needs an integer up/down ratio. Recordings sit near, but not exactly at, their nominal rate,
+    # so bound the denominator to keep the polyphase filter short.
+    ratio = Fraction(target_rate / sample_rate).limit_denominator(1000)
+    up, down = ratio.numerator, ratio.denominator
+
+    # The bounded ratio can miss target_rate by a few parts in 10^4 (e.g. 1001/1000 for 500/499.667 Hz).
+    # The time grid follows the true output rate, so times and intervals don't pick up that error.
+    actual_rate = sample_rate * up / down
+
+    resampled = DataFrame()
+    for col in data.select_dtypes('number').columns:
+        if col == 'Time':
+            continue
+        # padtype='line' stops the zero padding from dragging down the ends of signals with a DC offset
+        # Filter in double precision, but keep the column's own precision (float32 in the low-memory mode)
+        dtype = data[col].dtype if data[col].dtype == np.float32 else float
+        resampled[col] = sg.resample_poly(np.asarray(data[col], dtype=float), up, down, padtype='line').astype(dtype, copy=False)
+
+    start = data['Time'].iloc[0]
+    resampled.insert(0, 'Time', start + np.arange(len(resampled)) / (actual_rate * TIME_UNIT))
+    return resampled
+
 def _true_copy_arr(arr):
     "Makes a deep copy of a numpy array."
     return np.copy(arr)
@@ -102,9 +199,48 @@ Neurokit only has a mehtod for assessing ECG SQI, so will have to evaluate sqi a
 def _seg(signal,fs):
     return nk.ecg_segment(signal,sampling_rate=fs)
 
+def _seg_bounds(signal,fs):
+    """Returns the first and last sample index of every ECG pulse found by _seg, in pulse order.
+Pulses can be rebuilt from these with signal.reindex(range(start,end+1)), which keeps the NaN padding at the edges."""
+    segment_dict=_seg(signal,fs)
+    starts=np.array([segment_dict[str(x)]["Index"].iloc[0] for x in range(1,len(segment_dict)+1)],dtype=int)
+    ends=np.array([segment_dict[str(x)]["Index"].iloc[-1] for x in range(1,len(segment_dict)+1)],dtype=int)
+    return starts,ends
+
 def _kSQI(signal):
     return stats.kurtosis(signal,fisher=True)
 
+def _pulse_kSQI(signal,seg_start,seg_end):
+    """Kurtosis SQI of every ECG pulse given by _seg_bounds. 
+The last pulse is left at 0 (never passes the threshold) since it is usually cut short by the end of the recording."""
+    kSQI_arr=np.zeros(len(seg_start))
+    for x in range(1,len(seg_start)):
+        pulse = signal.reindex(range(seg_start[x-1],seg_end[x-1]+1))
+        kSQI_arr[x - 1] = _kSQI(pulse)
+    return kSQI_arr
+
+def _quality_windows(kSQI_arr,threshold=KSQI_THRESHOLD,length=WINDOW_PULSES,overlap=WINDOW_OVERLAP):
+    """Returns the index of the first pulse of every window of `length` consecutive pulses whose kSQI is all above threshold.
+Windows are taken from the start of the recording, and consecutive windows share at most `overlap` pulses."""
+    good=np.asarray(kSQI_arr) > threshold
+    if len(good) < length:
+        return np.zeros(0,dtype=int)
+
+    # Number of good pulses in every run of `length` consecutive pulses
+    counts=np.convolve(good.astype(int),np.ones(length,dtype=int),mode='valid')
+
+    firsts=[]
+    next_allowed=0
+    for i in np.flatnonzero(counts == length):
+        if i >= next_allowed:
+            firsts.append(i)
+            next_allowed=i+length-overlap
+    return np.array(firsts,dtype=int)
+
+def _real_values(bp_data,file):
+    "Finds the row of the blood pressure spreadsheet which belongs to a recording"
+    return bp_data[bp_data["Filename"].str.contains(file.strip(".csv"),regex=False)]
+
 def _ecg_quality_pSQI(
     ecg_cleaned,
     sampling_rate=1000,
@@ -133,3 +269,6 @@ def _get_ecg_peaks(signal,times,sample_rate):
     peaks=nk.ecg_findpeaks(np.copy(signal),sampling_rate=sample_rate,method="elgendi2010")["ECG_R_Peaks"]
     peak_times=times.iloc[peaks]
     return peaks,peak_times
+
+def _get_ppg_peaks(signal,sample_rate):
+    return nk.ppg_findpeaks(np.copy(signal),sampling_rate=sample_rate,method="elgendi")["PPG_Peaks"]
@@ -0,0 +1,190 @@
+import itertools
+import os
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+import numpy as np
+import neurokit2 as nk
+from pandas import DataFrame
+
+import signal_utils
+import preprocessing
+import feature_extraction
+import fiducial_store
+
+# ===============================================================================================================================
+# QUALITY THRESHOLD / WINDOW SIZE SWEEP
+# ===============================================================================================================================
+# Per-beat quality (kSQI) and per-beat fiducials (R/PPG peaks, delineation points) are computed once per recording over the
+# whole recording. Every (threshold, window length, overlap) setting then only selects its windows from the per-beat kSQI and
+# aggregates the beats inside each window with the usual window features, so a grid costs little more than one extraction.
+# Note the fiducials come from the whole recording rather than from each window, so values can differ slightly from "extract".
+
+def _beats(path, target_rate, fiducial_dir, dtype=None):
+    "Loads a recording and gets the per-beat data the sweep aggregates over. Returns None if it isn't an ECG recording"
+    # The file is read once, for both the store key and the parser
+    raw, rec_hash = fiducial_store._read_recording(path) if fiducial_dir is not None else (None, None)
+    data = signal_utils._load_csv(path, dtype, raw)
+    del raw
+    if data.empty or "ECG" not in data.columns:
+        return None
+
+    sample_rate = signal_utils._get_sample_rate(data)
+    if target_rate is not None:
+        data = signal_utils._resample(data, sample_rate, target_rate)
+        sample_rate = target_rate
+
+    # Shares its entries with "extract", so recordings it has seen are not cleaned or segmented again
+    fiducials = fiducial_store._open(fiducial_dir, path, fiducial_store._params(target_rate, dtype), rec_hash)
+    try:
+        data["ECG"] = fiducials.get("ECG_Clean", lambda: preprocessing._cleanECG(data["ECG"], sample_rate))
+        data["Red"] = fiducials.get("Red_Clean", lambda: preprocessing._cleanPPG(data["Red"], sample_rate))
+        seg_start, seg_end = fiducials.get("Seg_Bounds", lambda: signal_utils._seg_bounds(data["ECG"], sample_rate))
+
+        peaks = fiducials.get("Rec_ECG_R_Peaks", lambda: signal_utils._get_ecg_peaks(data["ECG"], data["Time"], sample_rate)[0])
+        ppg_peaks = fiducials.get("Rec_PPG_Peaks", lambda: signal_utils._get_ppg_peaks(data["Red"], sample_rate))
+        points = fiducials.get_points("Rec_ECG_Points", lambda: nk.ecg_delineate(data["ECG"], peaks, sampling_rate=sample_rate)[1])
+    finally:
+        fiducials.save()
+
+    return {
+        "data": data,
+        "fs": sample_rate,
+        "seg_start": seg_start,
+        "seg_end": seg_end,
+        "kSQI": signal_utils._pulse_kSQI(data["ECG"], seg_start, seg_end),
+        "peaks": peaks,
+        "ppg_peaks": ppg_peaks,
+        "points": points,
+    }
+
+def _window_context(beats, start, end):
+    "Builds the same window context as feature_extraction._window_context from the beats that fall inside [start, end]"
+    data = beats["data"].truncate(before=start, after=end)
+    offset = data.index[0]
+    n = len(data)
+
+    # Beats are identified by their R peak. Delineation points are aligned with the R peaks.
+    in_window = (beats["peaks"] >= offset) & (beats["peaks"] < offset + n)
+    peaks = beats["peaks"][in_window] - offset
+
+    ppg_peaks = beats["ppg_peaks"]
+    ppg_peaks = ppg_peaks[(ppg_peaks >= offset) & (ppg_peaks < offset + n)] - offset
+
+    points = {}
+    for name, values in beats["points"].items():
+        values = np.asarray(values, dtype=float)[in_window] - offset
+        # A point of a beat at the edge of the window can fall outside of it, treat it as missing
+        values[(values < 0) | (values >= n)] = np.nan
+        points[name] = values
+
+    return {"data": data, "fs": beats["fs"], "peaks": peaks, "peak_times": data["Time"].iloc[peaks], "ppg_peaks": ppg_peaks, "points": points}
+
+def _sweep_file(path, file, real, grid, target_rate, fiducial_dir, dtype=None):
+    """Worker for one recording: gets its beats once and derives its feature rows for every (threshold, length, overlap) in grid.
+Returns the filename, {setting: [rows]} (None if not an ECG recording), the number of windows which failed and an error.
+Any exception is handed back as the error (repr), so one bad recording can't abort the whole sweep."""
+    try:
+        rows, failed = _sweep_rows(path, file, real, grid, target_rate, fiducial_dir, dtype)
+    except Exception as e:
+        return file, None, 0, repr(e)
+    return file, rows, failed, None
+
+def _sweep_rows(path, file, real, grid, target_rate, fiducial_dir, dtype=None):
+    "Feature rows of one recording for every setting in grid and the number of failed windows. Rows are None if it isn't an ECG recording"
+    beats = _beats(path, target_rate, fiducial_dir, dtype)
+    if beats is None:
+        return None, 0
+
+    rows = {}
+    computed = {}
+    failed = 0
+    for threshold, length, overlap in grid:
+        rows[(threshold, length, overlap)] = []
+        for first_pulse in signal_utils._quality_windows(beats["kSQI"], threshold, length, overlap):
+            start = beats["seg_start"][first_pulse]
+            end = beats["seg_end"][first_pulse + length - 1]
+
+            # Settings often select the same windows, only aggregate each one once
+            if (start, end) not in computed:
+                try:
+                    context = _window_context(beats, start, end)
+                    row = {}
+                    for _, columns, func in feature_extraction.FEATURES.values():
+                        row.update(zip(columns, func(context)))
+                    computed[(start, end)] = row
+                except (KeyError, ValueError, IndexError, ZeroDivisionError):
+                    computed[(start, end)] = None
+
+            if computed[(start, end)] is None:
+                failed += 1
+                continue
+
+            row = {"Filename": file, "SBP": real[0], "DBP": real[1], "REAL_HR": real[2]}
+            row.update(computed[(start, end)])
+            rows[(threshold, length, overlap)].append(row)
+
+    return rows, failed
+
+def _grid(thresholds, lengths, overlaps):
+    "Every (threshold, length, overlap) setting. Overlaps of a whole window or more are left out"
+    return [(t, l, o) for t, l, o in itertools.product(thresholds, lengths, overlaps) if 0 <= o < l]
+
+def _output_name(setting):
+    "Name of the feature table written for a setting"
+    threshold, length, overlap = setting
+    return "ecg_Features_k{:g}_n{}_o{}.csv".format(threshold, length, overlap)
+
+def _sweep(csv_dir, bp_data, grid, target_rate=None, fiducial_dir=fiducial_store.STORE_DIR, dtype=None, workers=None):
+    """Runs the sweep over every recording in csv_dir (flat file hierarchy) on all cores.
+Returns {setting: DataFrame} in the ECG feature table schema, the number of failed windows and {file: reason} for every
+recording which wasn't swept ("error" or "interrupted"). On Ctrl-C the tables hold the recordings finished so far."""
+    files = sorted(f for f in os.listdir(csv_dir) if f.endswith(".csv"))
+    results = {}
+    skipped = {}
+    done = set()
+    failed = 0
+
+    with ProcessPoolExecutor(max_workers=workers) as pool:
+        futures = {}
+        for file in files:
+            real_values = signal_utils._real_values(bp_data, file)
+            if len(real_values) != 1:
+                print("No unique measured blood pressure found for " + file)
+                continue
+            real = (real_values.get('SBP').item(), real_values.get('DBP').item(), real_values.get('Real_HR').item())
+            futures[pool.submit(_sweep_file, os.path.join(csv_dir, file), file, real, grid, target_rate, fiducial_dir, dtype)] = file
+
+        try:
+            for future in as_completed(futures):
+                try:
+                    file, rows, file_failed, error = future.result()
+                except KeyboardInterrupt:
+                    raise
+                except Exception as e:
+                    # The worker itself died, e.g. BrokenProcessPool after it was killed for memory
+                    file, rows, file_failed, error = futures[future], None, 0, repr(e)
+                done.add(file)
+
+                if error is not None:
+                    print(file + ": " + error)
+                    skipped[file] = "error"
+                    continue
+
+                print("Swept: " + file)
+                if rows is not None:
+                    results[file] = rows
+                    failed += file_failed
+        except KeyboardInterrupt:
+            print("Got Keyboard interrupt, stopping")
+            pool.shutdown(wait=False, cancel_futures=True)
+            for file in futures.values():
+                if file not in done:
+                    skipped[file] = "interrupted"
+
+    # Assemble in file order so the tables don't depend on which worker finished first
+    tables = {setting: [] for setting in grid}
+    for file in sorted(results):
+        for setting in grid:
+            tables[setting].extend(results[file][setting])
+
+    return {setting: DataFrame(tables[setting], columns=feature_extraction.ECG_COLUMNS) for setting in grid}, failed, skipped
@@ -0,0 +1,42 @@
+import numpy as np
+import neurokit2 as nk
+import pytest
+from pandas import DataFrame
+
+import signal_utils
+import precision_check
+
+# Simulated recordings long enough for several windows of WINDOW_PULSES beats
+SAMPLE_RATE = 500
+DURATION = 60
+HEART_RATE = 70
+
+def _write_recording(path, columns):
+    "Writes signals in the layout of the device recordings: metadata rows, then the header at CSV_HEADER_ROW"
+    n = len(next(iter(columns.values())))
+    table = DataFrame({"Time": np.arange(n) * 1000 // SAMPLE_RATE, **columns})
+    with open(path, "w") as f:
+        for i in range(signal_utils.CSV_HEADER_ROW):
+            f.write("Meta" + str(i) + ",0\n")
+        table.to_csv(f, index=False)
+    return path
+
+def _assert_within_tolerance(path):
+    drift, compared, total = precision_check._drift(str(path))
+    assert total > 0 and compared > 0
+    for column, value in drift.items():
+        assert value <= precision_check.FLOAT32_TOLERANCE, column + " drifts by " + format(value, ".2e")
+
+def test_ecg_features_float32_drift(tmp_path):
+    ecg = nk.ecg_simulate(duration=DURATION, sampling_rate=SAMPLE_RATE, heart_rate=HEART_RATE, random_state=0)
+    ppg = nk.ppg_simulate(duration=DURATION, sampling_rate=SAMPLE_RATE, heart_rate=HEART_RATE, random_state=0)
+    _assert_within_tolerance(_write_recording(tmp_path / "ecg.csv", {"ECG": ecg, "Red": ppg}))
+
+def test_ppg_features_float32_drift(tmp_path):
+    ppg = nk.ppg_simulate(duration=DURATION, sampling_rate=SAMPLE_RATE, heart_rate=HEART_RATE, random_state=0)
+    _assert_within_tolerance(_write_recording(tmp_path / "ppg.csv", {"Green": ppg}))
+
+def test_unsupported_recording(tmp_path):
+    path = _write_recording(tmp_path / "imu.csv", {"Ax": np.zeros(SAMPLE_RATE)})
+    with pytest.raises(precision_check.UnsupportedRecording):
+        precision_check._drift(str(path))
@@ -9,11 +9,17 @@ from tkinter import filedialog
 import numpy as np
 import neurokit2 as nk
 from matplotlib import pyplot as plt
-from pandas import DataFrame, read_csv
+from pandas import DataFrame, concat, read_csv
 
 import signal_utils
 import feature_extraction
 import preprocessing
+import fiducial_store
+import feature_store
+import sweep
+import sharding
+import precision_check
+import ppg_feature_extraction
 
 banner = """                                                                          
        ___               __     __                     __         
@@ -36,6 +42,10 @@ data = None
 column = None
 signal = None
 sample_rate = None
+target_rate = None  # Canonical rate recordings are resampled to right after load. None keeps each file's own rate.
+fiducial_dir = fiducial_store.STORE_DIR  # Where "extract" persists neurokit results between runs. None disables the store.
+feature_dir = feature_store.STORE_DIR  # Where "extract" keeps computed window features between runs. None disables the store.
+signal_dtype = None  # np.float32 keeps signals in single precision from parsing to features. None keeps the parsed float64.
 
 # ===============================================================================================================================
 # CLI COMMANDS GO HERE
@@ -60,10 +70,119 @@ class vs_cli(cmd.Cmd):
         elif not os.path.isfile(arg.strip("'")):
             print("Not a file")
         else:
-            data = signal_utils._load_csv(arg.strip("'"))
+            data = signal_utils._load_csv(arg.strip("'"), signal_dtype)
             print(data.columns)  # TODO: pretty print this
             print("Data loaded!")
             sample_rate = signal_utils._get_sample_rate(data)
+            if target_rate is not None:
+                data = signal_utils._resample(data, sample_rate, target_rate)
+                sample_rate = target_rate
+                print("Resampled to " + str(target_rate) + " Hz")
+        return
+
+    def do_precision(self, arg):
+        """Set the precision signals are kept in from parsing through filtering and features. 32 halves the memory per recording.
+Use "precisioncheck" to see how far features drift from double precision.
+usage: precision 32|64"""
+        global signal_dtype
+
+        if arg == '':
+            print("Current precision: " + ("64" if signal_dtype is None else "32"))
+        elif arg.strip() == "32":
+            signal_dtype = np.float32
+            print("Signals will be kept as float32")
+        elif arg.strip() == "64":
+            signal_dtype = None
+            print("Signals will be kept as float64")
+        else:
+            print("Expected 32 or 64")
+        return
+
+    def do_precisioncheck(self, arg):
+        """Extracts the window features of one ECG or PPG recording in float32 and in float64, and reports how far each feature drifts.
+Fails a feature whose drift, relative to its largest magnitude, exceeds precision_check.FLOAT32_TOLERANCE.
+usage: precisioncheck \x1B[3mFILE\x1B[0m"""
+        if arg == '':
+            print("No file specfied")
+            return
+        elif not os.path.isfile(arg.strip("'")):
+            print("Not a file")
+            return
+
+        try:
+            drift, compared, total = precision_check._drift(arg.strip("'"), target_rate)
+        except precision_check.UnsupportedRecording as e:
+            # Neither ECG nor PPG columns
+            print(e)
+            return
+        except (KeyError, ValueError, IndexError, ZeroDivisionError) as e:
+            # The recording couldn't be loaded or segmented, like an "error" file in extract
+            print(e)
+            return
+        print("Compared " + str(compared) + " of " + str(total) + " windows")
+
+        failed = 0
+        for column, value in drift.items():
+            ok = value <= precision_check.FLOAT32_TOLERANCE
+            failed += not ok
+            print(column + ": " + format(value, ".2e") + ("" if ok else "  <-- exceeds " + format(precision_check.FLOAT32_TOLERANCE, ".0e")))
+        print("All features within tolerance" if failed == 0 else str(failed) + " features exceed the tolerance")
+        return
+
+    def do_resample(self, arg):
+        """Set the canonical sample rate that every recording is resampled to right after it is loaded (by "load" and "extract").
+usage: resample \x1B[3mSAMPLE_RATE\x1B[0m | off
+ex: resample 500"""
+        global target_rate
+
+        if arg == '':
+            print("Current target rate: " + ("off" if target_rate is None else str(target_rate) + " Hz"))
+        elif arg.strip() == "off":
+            target_rate = None
+            print("Resampling disabled")
+        else:
+            try:
+                rate = float(arg)
+            except ValueError:
+                print("Expected a sample rate in Hz or 'off'")
+                return
+            if rate <= 0:
+                print("Expected a positive sample rate")
+                return
+            target_rate = rate
+            print("Recordings will be resampled to " + str(target_rate) + " Hz")
+        return
+
+    def do_fiducials(self, arg):
+        """Set the directory of the fiducial sidecar store, where "extract" keeps cleaned signals, peaks and delineation points between runs.
+usage: fiducials \x1B[3mDIRECTORY\x1B[0m | off
+ex: fiducials .fiducials"""
+        global fiducial_dir
+
+        if arg == '':
+            print("Current fiducial store: " + ("off" if fiducial_dir is None else fiducial_dir))
+        elif arg.strip() == "off":
+            fiducial_dir = None
+            print("Fiducial store disabled")
+        else:
+            fiducial_dir = arg.strip("'")
+            print("Fiducials will be stored in " + fiducial_dir)
+        return
+
+    def do_features(self, arg):
+        """Set the directory of the feature store. "extract" only computes the (window, feature) values that are missing from it or stale.
+usage: features \x1B[3mDIRECTORY\x1B[0m | off
+ex: features .features"""
+        global feature_dir
+
+        if arg == '':
+            print("Current feature store: " + ("off" if feature_dir is None else feature_dir))
+        elif arg.strip() == "off":
+            feature_dir = None
+            print("Feature store disabled")
+        else:
+            feature_dir = arg.strip("'")
+            print("Features will be stored in " + feature_dir)
         return
 
     def do_select(self, arg):
@@ -232,16 +351,14 @@ ex: butter 4"""
             #print(f"kSQI:{kSQI}   pSQI:{pSQI}")
 
         #Getting the best 10 pulses
-        for i in range(len(kSQ)):
-            if int(kSQ[i]) > 6.0:
-                if (kSQ[i+1] > 6) & (kSQ[i+2] > 6) & (kSQ[i+2] > 6)& (kSQ[i+3] > 6) & (kSQ[i+4] > 6) &(kSQ[i + 5] > 6) & (kSQ[i+6] > 6) & (kSQ[i+7] > 6)& (kSQ[i+8] > 6) & (kSQ[i+9] > 6):
-                    lastvalue=i
-                    break
+        windows = signal_utils._quality_windows(kSQ[:,0])
+        if len(windows) > 0:
+            lastvalue = windows[0]
         j=0
         number = len(alpha["1"]["Signal"])
-        tenpulse = np.zeros([number*10, 1])
+        tenpulse = np.zeros([number*signal_utils.WINDOW_PULSES, 1])
         #for j in range(1310):
-        for ac2 in range(lastvalue+1,lastvalue+11,1):
+        for ac2 in range(lastvalue+1,lastvalue+signal_utils.WINDOW_PULSES+1,1):
             sig = alpha[str(ac2)]["Signal"]
             for val in sig:
                 tenpulse[j] = val
@@ -317,7 +434,10 @@ ex: butter 4"""
         return
 
     def do_extract(self,arg):
-        "extracts 'em all. First dialog is the directory with data, second dialog is the csv with measured bp."    
+        """extracts 'em all. First dialog is the directory with data, second dialog is the csv with measured bp.
+Optional flags: --shard k/N only processes the k-th of N shards of the recordings (see "merge"), --out DIR sets the output directory.
+A shard stopped with Ctrl-C keeps its complete recordings, but "merge" refuses it until it is run again.
+usage: extract [\x1B[3mDATA_DIRECTORY\x1B[0m \x1B[3mBP_FILE\x1B[0m] [--shard \x1B[3mk/N\x1B[0m] [--out \x1B[3mDIRECTORY\x1B[0m]"""    
         global data
         global sample_rate
         global signal     
@@ -330,6 +450,27 @@ ex: butter 4"""
 
         args=arg.split(" ")        
 
+        # Pull out the optional flags before looking at the positional arguments
+        try:
+            shard_opt=sharding._pop_option(args,"--shard")
+            out_dir=sharding._pop_option(args,"--out")
+            shard=sharding._parse_shard(shard_opt) if shard_opt is not None else None
+        except ValueError as e:
+            print(e)
+            return
+        if not args:
+            args=['']
+
+        if out_dir is None:
+            out_dir="."
+        elif not os.path.isdir(out_dir.strip("'")):
+            print("Not a path")
+            return
+        out_name=sharding._shard_name(*shard) if shard is not None else sharding.OUTPUT_NAME
+        out_path=os.path.join(out_dir.strip("'"),out_name+".csv")
+        ppg_out_name=sharding._shard_name(*shard,sharding.PPG_OUTPUT_NAME) if shard is not None else sharding.PPG_OUTPUT_NAME
+        ppg_out_path=os.path.join(out_dir.strip("'"),ppg_out_name+".csv")
+
         if len(args)==2:
             # Arguments provided
             csv_dir= args[0] 
@@ -366,156 +507,208 @@ ex: butter 4"""
         bp_data = read_csv(bp_filepath.strip("'"), delimiter=",")
 
         # Create an output dataframe with every available feature, a column for systolic pressure, diastolic pressure, and signal type 
-        ecg_columns=['Filename', 'SBP', 'DBP', 'REAL_HR', 'HR', 'HRV', 'RR', 'PAT', 
-                    'QRSd','PQ','QT','JT', 
-                    'AUCqrs_pos','AUCqrs_neg', 'AUCjt_pos', 'AUCjt_neg',
-                    'ENT', 'SKEW', 'KURT',
-                    'D1','D2','D3','D4','D5','D6','D7','D8','D9','D10','D11','D12']        
+        ecg_columns=feature_extraction.ECG_COLUMNS
         ecg_dataframe=DataFrame(columns=ecg_columns)
 
-        #TODO: ppg dataframe
+        ppg_columns=ppg_feature_extraction.PPG_COLUMNS
+        ppg_dataframe=DataFrame(columns=ppg_columns)
+
+        # Window features from earlier runs, so only new or changed features get computed
+        features = feature_store.FeatureStore(feature_dir, feature_extraction.FEATURES, fiducial_store._params(target_rate, signal_dtype))
 
         # For every file in the directory (Assuming a flat file hierarchy) 
         dir_list = os.listdir(csv_dir)   
         files = [f for f in dir_list if f.endswith(".csv")]
 
-        for file in files:  
+        # Only this shard's recordings. Every shard records the full listing, so "merge" can check nothing was skipped
+        listed = files
+        if shard is not None:
+            files = sharding._shard_files(files,*shard)
+            print("Shard " + str(shard[0]) + "/" + str(shard[1]) + ": " + str(len(files)) + " of " + str(len(listed)) + " files")
+        outcomes = {}
+
+        # Load (and hash, for the sidecar stores) the next few recordings on background threads while the current one is processed.
+        # Each file is read once, the parser works on the same bytes as the hash
+        def load(path):
+            if fiducial_dir is None and feature_dir is None:
+                return signal_utils._load_recording(path, target_rate, signal_dtype) + (None,)
+            raw, rec_hash = fiducial_store._read_recording(path)
+            return signal_utils._load_recording(path, target_rate, signal_dtype, raw) + (rec_hash,)
+        prefetcher = signal_utils.Prefetcher([os.path.join(csv_dir,f) for f in files], load)
+        loader = iter(prefetcher)
+
+        # Writes the tables (and the shard summary) of everything extracted so far
+        def write_outputs(interrupted=False):
+            ecg_dataframe.to_csv(out_path)
+            ppg_dataframe.to_csv(ppg_out_path)
+            if shard is not None:
+                # An interrupted shard is marked as such, and "merge" refuses it until it is run again
+                sharding._write_summary(out_dir.strip("'"),*shard,listed,outcomes,
+                                        {"errors":num_err,"missing":num_missing,"empty":num_empty,"ppg":num_ppg,"ecg":num_ecg},
+                                        interrupted)
+
+        while True:
+            # Ctrl-C usually lands while waiting on the next load, so it gets the same handling as during extraction
+            try:
+                path, loaded, load_error = next(loader)
+            except StopIteration:
+                break
+            except KeyboardInterrupt:
+                print("Got Keyboard interrupt, stopping")
+                write_outputs(True)
+                return
+            file = os.path.basename(path)
 
             print("Now Extracting: " + file)
+            fiducials = None
 
             # Try to load the CSV into a dataframe
             try:
-                data = signal_utils._load_csv(os.path.join(csv_dir,file))
-                sample_rate = signal_utils._get_sample_rate(data)                
+                # Errors from the background load are raised here, so they're counted like before
+                if load_error is not None:
+                    raise load_error
+                data, sample_rate, rec_hash = loaded
                     
                 # Get the real bp measurement
-                real_values=bp_data[bp_data["Filename"].str.contains(file.strip(".csv"),regex=False)]                
+                real_values=signal_utils._real_values(bp_data,file)
                 
                 # Check for validity. We'll see what checks we REALLY need when the automation breaks :)
                 if data.empty:
                     print("Empty data file!")
                     num_empty+=1
+                    outcomes[file]="empty"
                     continue
                 elif real_values.empty:
                     print("No measured blood pressure found!")
                     num_missing+=1
+                    outcomes[file]="missing"
                     continue 
                      
                 # Extract different features based on the signal type.
                 if "ECG" in data.columns:                
                     print("ECG data file")                    
 
+                    # Neurokit results are reused from the sidecar store when this recording was processed before with the same parameters
+                    fiducials = fiducial_store._open(fiducial_dir, path, fiducial_store._params(target_rate, signal_dtype), rec_hash)
+
                     # Clean both signals before proceeding  
-                    data["ECG"] = preprocessing._cleanECG(data["ECG"], sample_rate)
-                    data["Red"] = preprocessing._cleanPPG(data["Red"], sample_rate) 
+                    data["ECG"] = fiducials.get("ECG_Clean", lambda: preprocessing._cleanECG(data["ECG"], sample_rate))
+                    data["Red"] = fiducials.get("Red_Clean", lambda: preprocessing._cleanPPG(data["Red"], sample_rate))
                     
                     # Temporary dataframe for holding features as they are calculated
-                    temp_df=DataFrame(columns=ecg_columns)                                   
+                    temp_df=DataFrame(columns=ecg_columns)
+
+                    # Stored features follow the recording's content, not its filename
+                    rec=rec_hash if rec_hash is not None else path                                   
                     
-                    # Get a few nice, consecutive pulses                                       
-                    segment_dict = signal_utils._seg(data["ECG"],sample_rate) # Spits out a dictionary with every ECG pulse 
-                    num_segments=len(segment_dict)
+                    # Get a few nice, consecutive pulses. Keep the first and last sample index of every ECG pulse
+                    seg_start, seg_end = fiducials.get("Seg_Bounds", lambda: signal_utils._seg_bounds(data["ECG"],sample_rate))
 
                     # Evaluate the quality of each ECG pulse using Kurtosis
-                    kSQI_arr=np.zeros(num_segments)
-                    for x in range(1,num_segments):                        
-                        pulse = segment_dict[str(x)]["Signal"]
-                        kSQI_arr[x - 1] = signal_utils._kSQI(pulse)
+                    kSQI_arr=signal_utils._pulse_kSQI(data["ECG"],seg_start,seg_end)
 
                     #=============================================================
-                    first_pulse=0
-                    for i in range(len(kSQI_arr)-9):
+                    #Get windows of consecutive (nice) pulses.
+                    for first_pulse in signal_utils._quality_windows(kSQI_arr):
+                        last_pulse=first_pulse+signal_utils.WINDOW_PULSES-1
+
+                        # Get the first index of the first nice pulse, and the last index of the last nice pulse
+                        start=seg_start[first_pulse]
+                        end=seg_end[last_pulse]
+
+                        # Truncate the whole dataset to the size of those 10 pulses
+                        data_temp=data.truncate(before=start,after=end)
+                        #data=data.reset_index()
+
+                        # fig, (ax1, ax2) = plt.subplots(2, 1,sharex=True)
+                        # ax1.plot(data["Time"],data["ECG"])
+                        # ax2.plot(data["Time"],data["Red"])
+                        # plt.show()                     
+
+                        # Only compute the features this window doesn't have stored yet
+                        missing = features.missing(rec, start, end)
+                        if missing:
+                            # Mark the various components of the ECG
+                            context = feature_extraction._window_context(data_temp, sample_rate, fiducials, "W" + str(start) + "_" + str(end) + "_")
+                            for name in missing:
+                                features.put(name, rec, start, end, feature_extraction.FEATURES[name][2](context))
+
+                        # Get features
+                        for column, value in features.row(rec, start, end).items():
+                            temp_df.at[0,column]=value
+
+                        # Add the filename and true blood pressure to the temporary dataframe
+                        temp_df.at[0,'Filename']=file
+                        temp_df.at[0,'REAL_HR']=real_values.get('Real_HR').item()
+                        temp_df.at[0,'SBP']=real_values.get('SBP').item()
+                        temp_df.at[0,'DBP']=real_values.get('DBP').item()                            
                         
-                        #Get 10 consective (nice) pulses.                       
-                        if ((kSQI_arr[i]>6) & (kSQI_arr[i+1] > 6) & (kSQI_arr[i+2] > 6) & (kSQI_arr[i+2] > 6) & (kSQI_arr[i+3] > 6) & (kSQI_arr[i+4] > 6) 
-                                & (kSQI_arr[i + 5] > 6) & (kSQI_arr[i+6] > 6) & (kSQI_arr[i+7] > 6) & (kSQI_arr[i+8] > 6) & (kSQI_arr[i+9] > 6)):
-                                
-                            first_pulse=i
-                            last_pulse=first_pulse+9
-
-                            # Get the first index of the first nice pulse, and the last index of the last nice pulse
-                            start=segment_dict[str(first_pulse+1)]["Index"].iloc[0]
-                            end=segment_dict[str(last_pulse+1)]["Index"].iloc[-1]
-
-                            # Truncate the whole dataset to the size of those 10 pulses
-                            data_temp=data.truncate(before=start,after=end)
-                            #data=data.reset_index()
-
-                            # fig, (ax1, ax2) = plt.subplots(2, 1,sharex=True)
-                            # ax1.plot(data["Time"],data["ECG"])
-                            # ax2.plot(data["Time"],data["Red"])
-                            # plt.show()                     
+                        # Append to output dataframe
+                        ecg_dataframe=ecg_dataframe.append(temp_df)
+                        num_ecg+=1
 
-                            # Mark the various components of the ECG
-                            [peaks,peak_times]=signal_utils._get_ecg_peaks(data_temp["ECG"],data_temp["Time"],sample_rate) 
-                            _, points = nk.ecg_delineate(data_temp["ECG"], peaks, sampling_rate=sample_rate)
-
-                            # Get features                     
-                            temp_df.at[0,'HR']= feature_extraction._ecg_heart_rate(peak_times)
-                            temp_df.at[0,'HRV']=feature_extraction._hrv(peak_times)
-                            temp_df.at[0,'RR']=feature_extraction._rr_interval(peaks,sample_rate)
-                            temp_df.at[0,'PAT']=feature_extraction._pulse_arrival_time(data_temp,sample_rate,"Red")
-                            temp_df.at[0,'QRSd']=feature_extraction._avg_time_interval(data_temp["Time"],points["ECG_Q_Peaks"],points["ECG_S_Peaks"]) 
-                            temp_df.at[0,'PQ']=feature_extraction._avg_time_interval(data_temp["Time"],points["ECG_P_Onsets"],points["ECG_Q_Peaks"]) 
-                            temp_df.at[0,'QT']=feature_extraction._avg_time_interval(data_temp["Time"],points["ECG_Q_Peaks"],points["ECG_T_Offsets"]) 
-                            temp_df.at[0,'JT']=feature_extraction._avg_time_interval(data_temp["Time"],points["ECG_S_Peaks"],points["ECG_T_Peaks"]) 
-                            temp_df.at[0,'AUCqrs_pos']=feature_extraction._avg_area_under_curve(data_temp["ECG"].clip(lower=0,upper=None),points["ECG_Q_Peaks"],points["ECG_S_Peaks"])
-                            temp_df.at[0,'AUCqrs_neg']=feature_extraction._avg_area_under_curve(data_temp["ECG"].clip(lower=None,upper=0),points["ECG_Q_Peaks"],points["ECG_S_Peaks"])
-                            temp_df.at[0,'AUCjt_pos']=feature_extraction._avg_area_under_curve(data_temp["ECG"].clip(lower=0,upper=None),points["ECG_S_Peaks"],points["ECG_T_Offsets"])
-                            temp_df.at[0,'AUCjt_neg']=feature_extraction._avg_area_under_curve(data_temp["ECG"].clip(lower=None,upper=0),points["ECG_S_Peaks"],points["ECG_T_Offsets"])
-                            temp_df.at[0,'ENT']=feature_extraction._sample_entropy(data_temp["ECG"])
-                            temp_df.at[0,'SKEW']=feature_extraction._skew(data_temp["ECG"])
-                            temp_df.at[0,'KURT']=feature_extraction._kurt(data_temp["ECG"])                   
-
-                            D=feature_extraction._decompose(data_temp["ECG"])[0]
-                            for x in range(1,12):
-                                temp_df.at[0,'D'+str(x)]=D[x-1]
-
-                            # Add the filename and true blood pressure to the temporary dataframe
-                            temp_df.at[0,'Filename']=file
-                            temp_df.at[0,'REAL_HR']=real_values.get('Real_HR').item()
-                            temp_df.at[0,'SBP']=real_values.get('SBP').item()
-                            temp_df.at[0,'DBP']=real_values.get('DBP').item()                            
-                            
-                            # Append to output dataframe
-                            ecg_dataframe=ecg_dataframe.append(temp_df)
-                            num_ecg+=1
-
-                            # Look for next 10 pulses
-                            i=i+9 # It'll get incremented again by the loop 
-                        else:                            
-                            continue
+                    # Only recorded once every window is in, so an interrupted file never counts as processed
+                    outcomes[file]="ecg"
                         
                 #=============================================================
                 
                 elif "Green" in data.columns or "GREEN" in data.columns:
                     print("PPG data file") 
                     
-                    #TODO: Evaluate the ppg quality
-                    #TODO: get ppg
+                    channel = "Green" if "Green" in data.columns else "GREEN"
+
+                    # Cleaned signal and systolic peaks go through the sidecar store too
+                    fiducials = fiducial_store._open(fiducial_dir, path, fiducial_store._params(target_rate, signal_dtype), rec_hash)
+                    ppg = fiducials.get("Green_Clean", lambda: preprocessing._cleanPPG(data[channel], sample_rate))
+                    ppg_peaks = fiducials.get("Green_Peaks", lambda: signal_utils._get_ppg_peaks(ppg, sample_rate))
+
+                    # Every beat's fiducials and features in one pass, then averaged over windows of good beats
+                    temp_df = ppg_feature_extraction._ppg_windows(ppg, data["Time"], sample_rate, ppg_peaks)
+                    temp_df.insert(0, 'Filename', file)
+                    temp_df.insert(1, 'SBP', real_values.get('SBP').item())
+                    temp_df.insert(2, 'DBP', real_values.get('DBP').item())
+                    temp_df.insert(3, 'REAL_HR', real_values.get('Real_HR').item())
+                    ppg_dataframe=concat([ppg_dataframe, temp_df], ignore_index=True)
+
                     num_ppg+=1
+                    outcomes[file]="ppg"
                     continue     
                 else:
                     print("Couldn't find an the expected columns")
+                    outcomes[file]="unknown"
                     continue          
             except KeyError as e:
                 # This happens when the time column cannot be found in the sample rate calculation.
                 num_err+=1
+                outcomes[file]="error"
                 print(e)                   
             except ValueError as e:
                 # This happens when there are duplicate entries in the blood pressure spreadsheet. 
                 num_err+=1
+                outcomes[file]="error"
                 print(e) 
             except IndexError as e:                                
                 num_err+=1
+                outcomes[file]="error"
                 print(e)                
             except ZeroDivisionError as e:
                 num_err+=1
+                outcomes[file]="error"
                 print(e)
             except KeyboardInterrupt:
                 print("Got Keyboard interrupt, stopping")
-                ecg_dataframe.to_csv("ecg_Features.csv")
+                # Leave out the rows of the file which was cut short, the outputs only hold complete recordings
+                partial=ecg_dataframe['Filename']==file
+                num_ecg-=int(partial.sum())
+                ecg_dataframe=ecg_dataframe[~partial]
+                outcomes.pop(file,None)
+                write_outputs(True)
                 return   
+            finally:
+                # Keep whatever neurokit results were computed, even if feature extraction failed part way
+                if fiducials is not None:
+                    fiducials.save()
+                features.save()
                 
                 # fig, (ax1, ax2) = plt.subplots(2, 1,sharex=True)
                 # ax1.plot(data["Time"],data["ECG"])
@@ -523,16 +716,161 @@ ex: butter 4"""
                 # plt.show()                           
 
         # Write the output dataframe to a csv
-        ecg_dataframe.to_csv("ecg_Features.csv")
-
-        #TODO write ppg dataframe
+        write_outputs()
 
         print("\nnumber of errors: " + str(num_err))
         print("number of signals w/o blood pressure: " + str(num_missing))
         print("number of empty files: " + str(num_empty))
         print("number of ppg files: " + str(num_ppg))
         print("number of ecg files: " + str(num_ecg))        
+        print("time waiting on file loads: " + format(prefetcher.io_wait, ".1f") + " s")
+
+        return
+
+    def do_merge(self, arg):
+        """Combines the outputs of "extract --shard k/N" for k = 1..N into one ecg_Features.csv and one ppg_Features.csv, without duplicate rows.
+Refuses to merge if a shard is missing or was interrupted, or if any recording was processed twice or not at all.
+usage: merge \x1B[3mN\x1B[0m [\x1B[3mDIRECTORY\x1B[0m]
+ex: merge 4 ./shards"""
+        args = arg.split()
+
+        if len(args) not in (1, 2):
+            print("Wrong number of arguments")
+            return
+        try:
+            num_shards = int(args[0])
+        except ValueError:
+            print("Expected the number of shards")
+            return
+        out_dir = args[1].strip("'") if len(args) == 2 else "."
+        if not os.path.isdir(out_dir):
+            print("Not a path")
+            return
+
+        merged, counters, problems = sharding._merge(out_dir, num_shards)
+        for problem in problems:
+            print(problem)
+        if merged is None:
+            print("Not merged")
+            return
+
+        for name, table in merged.items():
+            table.to_csv(os.path.join(out_dir, name + ".csv"))
+            print("Merged " + str(len(table)) + " rows from " + str(num_shards) + " shards into " + name + ".csv")
+        for key, value in counters.items():
+            print("number of " + key + ": " + str(value))
+        return
+
+    def do_sweep(self, arg):
+        """Builds one feature table per (kSQI threshold, window length, window overlap) setting, computing per-beat data only once per recording.
+Lists are comma separated. Window length and overlap are in pulses. "extract" uses threshold 6, length 10 and overlap 9.
+usage: sweep \x1B[3mDATA_DIRECTORY\x1B[0m \x1B[3mBP_FILE\x1B[0m \x1B[3mTHRESHOLDS\x1B[0m \x1B[3mLENGTHS\x1B[0m \x1B[3mOVERLAPS\x1B[0m
+ex: sweep ./data ./bp.csv 4,6,8 5,10,20 0,4,9"""
+        args = arg.split()
+
+        if len(args) != 5:
+            print("Wrong number of arguments")
+            return
+        elif not os.path.isdir(args[0].strip("'")):
+            print("Not a path")
+            return
+        elif not os.path.isfile(args[1].strip("'")):
+            print("Not a file")
+            return
+
+        try:
+            thresholds = [float(x) for x in args[2].split(",")]
+            lengths = [int(x) for x in args[3].split(",")]
+            overlaps = [int(x) for x in args[4].split(",")]
+        except ValueError:
+            print("Expected comma separated numbers")
+            return
+
+        grid = sweep._grid(thresholds, lengths, overlaps)
+        if not grid:
+            print("No valid settings, the overlap must be smaller than the window length")
+            return
+
+        bp_data = read_csv(args[1].strip("'"), delimiter=",")
+        tables, failed, skipped = sweep._sweep(args[0].strip("'"), bp_data, grid, target_rate, fiducial_dir, signal_dtype)
+
+        # Written even after Ctrl-C or failed recordings, with whatever was swept
+        for setting, table in tables.items():
+            table.to_csv(sweep._output_name(setting))
+            print(sweep._output_name(setting) + ": " + str(len(table)) + " windows")
+        print("number of failed windows: " + str(failed))
+        print("number of failed files: " + str(sum(r == "error" for r in skipped.values())))
+        print("number of interrupted files: " + str(sum(r == "interrupted" for r in skipped.values())))
+        return
+
+    def do_train(self, arg):
+        """Trains SBP and DBP regressors on a feature table with a subject-grouped holdout and cross-validated hyperparameter search on all cores.
+Reports MAE, mean error and SD on the holdout against the BHS and AAMI criteria, and saves the models for the inference server.
+usage: train \x1B[3mFEATURE_FILE\x1B[0m rf|mlp [\x1B[3mMODEL_FILE\x1B[0m]
+ex: train ecg_Features.csv rf bp_model_rf.joblib"""
+        args = arg.split()
+
+        if len(args) not in (2, 3):
+            print("Wrong number of arguments")
+            return
+        elif not os.path.isfile(args[0].strip("'")):
+            print("Not a file")
+            return
+        elif args[1] not in ("rf", "mlp"):
+            print("Expected 'rf' or 'mlp'")
+            return
+        model_file = args[2].strip("'") if len(args) == 3 else "bp_model_" + args[1] + ".joblib"
+
+        # scikit-learn and joblib are only needed here and in "serve", so the rest of the tool works without them
+        import bp_models
+
+        table, columns = bp_models._load_features(args[0].strip("'"))
+        try:
+            train, test = bp_models._grouped_split(table)
+            print("Training on " + str(len(train)) + " windows, testing on " + str(len(test)))
+            models = bp_models._train(train, columns, args[1])
+        except ValueError as e:
+            # Too few subjects to hold some out and cross-validate on the rest
+            print(e)
+            return
+        report = bp_models._evaluate(models, test, columns)
+
+        for target, scores in report.items():
+            print(target + ": MAE " + format(scores['MAE'], ".2f") + ", ME " + format(scores['ME'], ".2f") + ", SD " + format(scores['SD'], ".2f")
+                  + " mmHg | BHS grade " + scores['BHS'] + " (" + "/".join(format(w, ".0f") for w in scores['within_5_10_15']) + "% within 5/10/15)"
+                  + " | AAMI " + ("pass" if scores['AAMI'] else "fail"))
+
+        bp_models._save(models, columns, model_file)
+        print("Models saved to " + model_file)
+        return
+
+    def do_serve(self, arg):
+        """Serves SBP/DBP estimates for raw ECG/PPG windows over local HTTP, with the models from "train" loaded once and kept warm.
+POST /predict with {"fs": ..., "ecg": [...], "ppg": [...]} returns {"SBP": ..., "DBP": ...}. GET /metrics returns latency percentiles and throughput.
+Add "pad": N with N extra samples of signal on each side of the window to clean it like "extract" does. They're cropped before the features.
+Windows are resampled to the "resample" rate first, if one is set. Stop with Ctrl-C.
+usage: serve \x1B[3mMODEL_FILE\x1B[0m [\x1B[3mPORT\x1B[0m]
+ex: serve bp_model_rf.joblib 8008"""
+        args = arg.split()
+
+        if len(args) not in (1, 2):
+            print("Wrong number of arguments")
+            return
+        elif not os.path.isfile(args[0].strip("'")):
+            print("Not a file")
+            return
+
+        import inference_server
+
+        port = inference_server.DEFAULT_PORT
+        if len(args) == 2:
+            try:
+                port = int(args[1])
+            except ValueError:
+                print("Expected a port number")
+                return
 
+        inference_server._serve(args[0].strip("'"), port, target_rate)
         return
 
 def main():